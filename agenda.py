@@ -1,19 +1,39 @@
 # Console agenda - copyright (c) 2021 Nicolas P. Rougier
 # Released under the GNU General Public Licence version 3
 
+import os
 import re
+import sys
+import math
+import bisect
 import calendar
+import hashlib
+import functools
 import datetime
-import orgparse
-    
+import multiprocessing
+import concurrent.futures
+import scanner
+import instrument
+from index import EventStore
+from layout import Layout, MONTH_COLS, MONTH_ROWS
+
+# Name and version of the parser producing event records (used by the cache)
+PARSER = "orgparse", 3
+
 class Event:
     """ Representation of an agenda event as (start, end, description) """
-    
-    def __init__(self, description, start, end=None, special=False):
-        """ Create a new event. """
+
+    __slots__ = ("description", "special", "repeat", "tags", "start_date",
+                 "start_time", "end_date", "end_time")
+
+    def __init__(self, description, start, end=None, special=False, repeat=None, tags=()):
+        """ Create a new event (repeat is the (kind, value, unit) repeater
+        of the event this one is an occurrence of). """
         
         self.description = description
         self.special = special
+        self.repeat = repeat
+        self.tags = tags
 
         # Start date and time
         if isinstance(start, datetime.datetime):
@@ -102,26 +122,120 @@ class Event:
         return s
 
 
+# ----------------------------------------------------------------------
+def parse(text, filename="<string>", skip=False):
+    """ Parse org text and return the list of its (unsorted) events as
+    (description, start, end, special, repeat, tags) records where repeat
+    is the (kind, value, unit) repeater of the timestamp, if any, and tags
+    are the sorted tags of the heading (including inherited ones). If skip,
+    archived (ARCHIVE tag) and commented (COMMENT keyword) subtrees are
+    ignored. """
+
+    import orgparse
+
+    records = []
+    root = orgparse.loads(text, filename)
+    skipped = 0    # level of skipped subtree (0 if none)
+    for node in root.env.nodes[1:]:
+        if skipped and node.level > skipped:
+            continue
+        skipped = 0
+        if skip and ("ARCHIVE" in node.shallow_tags or is_comment(node.heading)):
+            skipped = node.level
+            continue
+        heading = node.heading
+        heading = re.sub("\[.*\]|\<.*\>|NEXT|TODO", "", heading)
+        heading = heading.strip()
+        tags = tuple(sorted(node.tags))
+
+        if node.deadline:
+            records.append((heading, node.deadline.start, None, True,
+                            getattr(node.deadline, "_repeater", None), tags))
+
+        for date in node.get_timestamps(active=True, point=True, range=True):
+            records.append((heading, date.start, date.end, False,
+                            getattr(date, "_repeater", None), tags))
+    return records
+
+
+def is_comment(heading):
+    """ Check if heading (without todo keyword and priority) is commented. """
+
+    return heading == "COMMENT" or heading.startswith("COMMENT ")
+
+
+# Available parsers as name -> (parse function, parser name and version)
+PARSERS = { "orgparse": (parse, PARSER),
+            "fast":     (scanner.parse, scanner.PARSER) }
+
+# Start method of parsing processes: load runs in worker threads and forking
+# a multi-threaded process may deadlock
+CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Available scales to map day load to heat map levels (0 to 9)
+SCALES = "linear", "log", "quantile"
+
+# Kinds of day (flags)
+WEEKEND = 1
+HOLIDAY = 2
+
+
 # ----------------------------------------------------------------------
 class Agenda:
     """ Agenda class """
 
-    def __init__(self, filenames, holidays, style):
-        """ Build a new agenda from given filenames, style and holidays"""
-
-        self.origin = 1,1
+    def __init__(self, filenames, holidays, style, cache=None, jobs=1, parser="orgparse",
+                 scale="linear", weighted=False, skip=False, defer=False):
+        """ Build a new agenda from given filenames, style and holidays,
+        using the (optional) on-disk cache of parsed events and parsing
+        files with jobs processes (0 means one per CPU) and the given
+        parser ("orgparse" or "fast"). Day load (number of events or
+        hours if weighted) is mapped to heat map levels using the given
+        scale ("linear", "log" or "quantile").
+
+        If skip, archived and commented subtrees are ignored. If defer,
+        archive files (*.org_archive) are only parsed once a year before
+        the year of the first event of other files is shown (see
+        undefer). """
+
+        self.layout = Layout()
         self.year = datetime.date.today().year
         self.style = style
         self.holidays = holidays
         self.filenames = filenames
+        self.deferred = []
+        if defer:
+            self.filenames = [name for name in filenames if not name.endswith(".org_archive")]
+            self.deferred = [name for name in filenames if name.endswith(".org_archive")]
         self.terminal = None
+        self.cache = cache
+        self.jobs = jobs
+        self.parse, self.parser = PARSERS[parser]
+        if skip:
+            # Records differ, and so do cache entries
+            self.parse = functools.partial(self.parse, skip=True)
+            self.parser = self.parser + ("skip",)
+        self.scale = scale
+        self.weighted = weighted
+        self.store = EventStore()
+        self.sources = {}        # filename -> (mtime, size, digest)
+        self.cells = {}          # day ordinal -> formatted day
+        self.months = {}         # (year, month) -> formatted month
+        self.heats = {}          # year -> (first day ordinal, levels, specials)
+        self.days = {}           # year -> (first day ordinal, kinds, holiday names)
+        self.query = ""          # search query
+        self.matches = None      # ids of events matching query (None if no query)
+        self.found = {}          # year -> day ordinals with matching events
+        self.today = datetime.date.today()
+        self.rendered_style = style
         self.populate()
         
 
     def is_weekend(self, year, month, day):
         """ Check if date is Sarturday or Sunday """
         
-        return datetime.date(year, month, day).weekday() in [5,6]
+        return self.kind(datetime.date(year, month, day)) & WEEKEND != 0
 
     def is_today(self, year, month, day):
         """ Check if date is today """
@@ -131,98 +245,334 @@ class Agenda:
     def is_vacant(self, year, month, day):
         """ Check if day is vacant """
         
-        return datetime.date(year, month, day) in self.holidays
+        return self.kind(datetime.date(year, month, day)) & HOLIDAY != 0
+
+    def kind(self, date):
+        """ Return kind of date (WEEKEND and HOLIDAY flags) """
+
+        first, kinds, names = self.year_days(date.year)
+        return kinds[date.toordinal() - first]
+
+    def holiday(self, date):
+        """ Return holiday name of date (None if not a holiday) """
+
+        first, kinds, names = self.year_days(date.year)
+        return names.get(date.toordinal())
+
+    def year_days(self, year):
+        """ Return (first day ordinal, kinds, names) of year where kinds
+        are the WEEKEND and HOLIDAY flags of days and names maps holiday
+        day ordinals to holiday names. Holidays are read once per year,
+        from the on-disk cache if any. """
+
+        if year in self.days:
+            return self.days[year]
+
+        first = datetime.date(year, 1, 1).toordinal()
+        size = datetime.date(year, 12, 31).toordinal() - first + 1
+        weekday = datetime.date(year, 1, 1).weekday()
+        kinds = bytearray(WEEKEND if (weekday+i) % 7 >= 5 else 0 for i in range(size))
+
+        # Holidays objects (see python-holidays) are identified by country,
+        # subdivision and library version, anything else is not cached
+        country = getattr(self.holidays, "country", None)
+        if country is not None and self.cache is not None:
+            module = sys.modules.get(type(self.holidays).__module__.split(".")[0])
+            country = (country, getattr(self.holidays, "subdiv", None),
+                       getattr(module, "__version__", None))
+            names = self.cache.get_holidays(country, year)
+        else:
+            country, names = None, None
+        if names is None:
+            # Membership test expands holidays of the year (python-holidays)
+            datetime.date(year, 1, 1) in self.holidays
+            names = { date.toordinal(): name for date, name in self.holidays.items()
+                                             if date.year == year }
+            if country is not None:
+                self.cache.set_holidays(country, year, names)
+
+        for ordinal in names:
+            kinds[ordinal-first] |= HOLIDAY
+        self.days[year] = first, kinds, names
+        return self.days[year]
 
 
     def get_day(self, mouse):
         """ Find the day and month under mouse. """
 
-        year = self.year
-        month_cols = 7*3
-        month_rows = 8
-        months_per_row = 4
+        return self.layout.day(self.year, mouse)
 
-        x, y = mouse[0]-self.origin[0], mouse[1]-self.origin[1]
-        month = 1 + ( x // (month_cols+1)) + months_per_row * (y // (month_rows+1))
-        if month < 1 or month > 12:
-            return None, None, None
 
-        mx = (month_cols+1)*((month-1) % months_per_row)
-        x -= mx
-    
-        my = (month_rows+1)*((month-1) // months_per_row)
-        y -= my
+    @instrument.timed("populate")
+    def populate(self):
+        """ Populate the agenda, only parsing files that changed since last call.
 
-        # x can be greater than month_cols because of separation between months
-        if x >= month_cols:
-            return None, None, None
-    
-        first = calendar.weekday(year, month, 1)
-        last  = calendar.monthrange(year, month)[1]
-        day = (y-2)*7 + x // 3 - first + 1
-        if day < 1 or day > last:
-            return None, None, None
-        else:
-            x = self.origin[0] + mx + 3*(x//3)
-            y = self.origin[1] + my + y
-            return month, day, (x,y)
+        Returns the set of day ordinals whose events changed (True if any
+        day may have changed). """
 
+        return self.merge(self.load())
 
-    def populate(self):
-        """ Populate the agenda. """
-        
-        self.events = {}
+    def modified(self):
+        """ Check (from file stamps only) if files changed since last merge. """
+
+        for filename in self.sources.keys():
+            if filename not in self.filenames:
+                return True
         for filename in self.filenames:
-            root = orgparse.load(filename)
-            for node in root.env.nodes[1:]:
-                heading = node.heading
-                heading = re.sub("\[.*\]|\<.*\>|NEXT|TODO", "", heading)
-                heading = heading.strip()
-                
-                if node.deadline:
-                    d = node.deadline.start
-                    key = d.year, d.month, d.day
-                    day_events = self.events.get(key, [])
-                    day_events.append( Event(heading, node.deadline.start, special=True) )
-                    self.events[key] = day_events
-        
-                for date in node.get_timestamps(active=True, point=True, range=True):
-                    d = date.start
-                    key = d.year, d.month, d.day
-                    day_events = self.events.get(key, [])
-                    day_events.append(Event(heading, date.start, date.end))
-                    self.events[key] = day_events
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                if filename in self.sources:
+                    return True
+                continue
+            source = self.sources.get(filename)
+            if source is None or source[:2] != (stat.st_mtime_ns, stat.st_size):
+                return True
+        return False
+
+    @instrument.timed("load")
+    def load(self):
+        """ Find and parse files that changed since last merge, without
+        modifying the agenda (such that it can run in a worker thread).
+
+        Returns a patch for merge as a list of (filename, source, records)
+        where source is None for removed files and records is None for
+        files whose content did not change. """
+
+        patch = []
+
+        # Files that are no longer part of the agenda
+        for filename in self.sources.keys():
+            if filename not in self.filenames:
+                patch.append((filename, None, None))
+
+        # Find out which files need to be (re)parsed
+        updates = []
+        for filename in self.filenames:
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                if filename in self.sources:
+                    patch.append((filename, None, None))
+                continue
+
+            # Same modification time and size: assume unchanged
+            stamp = stat.st_mtime_ns, stat.st_size
+            source = self.sources.get(filename)
+            if source is not None and source[:2] == stamp:
+                continue
+
+            # Cached records for this very stamp, else read file content
+            cached = self.cache.get(filename, stamp, self.parser) if self.cache else None
+            if cached is not None:
+                digest, records = cached
+                text = None
+            else:
+                with open(filename, "rb") as file:
+                    content = file.read()
+                digest = hashlib.sha1(content).hexdigest()
+                records = None
+                text = content.decode("utf8")
+
+            # Same content (e.g. file was only touched): nothing to parse
+            if source is not None and source[2] == digest:
+                patch.append((filename, stamp + (digest,), None))
+                continue
+            updates.append([filename, stamp, digest, text, records])
+
+        # Parse files, in parallel if asked and worth it
+        pending = [update for update in updates if update[4] is None]
+        if self.jobs != 1 and len(pending) > 1:
+            jobs = min(self.jobs or os.cpu_count(), len(pending))
+            with concurrent.futures.ProcessPoolExecutor(jobs, CONTEXT) as executor:
+                results = executor.map(self.parse, [update[3] for update in pending],
+                                              [update[0] for update in pending])
+                for update, records in zip(pending, results):
+                    update[4] = records
+        else:
+            for update in pending:
+                update[4] = self.parse(update[3], update[0])
+        for filename, stamp, digest, text, records in pending:
+            if self.cache:
+                self.cache.set(filename, stamp, self.parser, digest, records)
+
+        for filename, stamp, digest, text, records in updates:
+            patch.append((filename, stamp + (digest,), records))
+        return patch
+
+    @instrument.timed("merge")
+    def merge(self, patch):
+        """ Apply a patch computed by load and return changed day ordinals
+        (True if any day may have changed). """
+
+        removed, added = [], {}
+        for filename, source, records in patch:
+            if source is None:
+                self.sources.pop(filename, None)
+                removed.append(filename)
+            else:
+                self.sources[filename] = source
+                if records is not None:
+                    added[filename] = records
+
+        changed = set()
+        if removed or added:
+            changed = self.store.update(removed, added)
+        if changed is None:
+            # Repeating events changed, any day may have changed
+            self.invalidate()
+            changed = True
+        else:
+            self.invalidate(changed)
+        if self.query and (removed or added):
+            # Events changed and so may have matches
+            self.search(self.query)
+        return changed
+
+    def day_events(self, date):
+        """ Return sorted events of date, including multi-day events spanning it. """
+
+        return self.range_events(date, date)
+
+    def range_events(self, start, end):
+        """ Return sorted events overlapping [start, end] dates. """
+
+        records = self.store.records(start.toordinal(), end.toordinal(), self.matches)
+        return [Event(*record) for record in records]
+
+    def search(self, query):
+        """ Only keep events matching query (all words, last one being a
+        prefix) and return the number of matching events. Days with
+        matching events are highlighted. """
+
+        self.query, self.matches = query, self.store.search(query)
+        found, self.found = self.found, {}
+        # Years with formatted days or months (whether or not heat is known)
+        years = set(year for year, month in self.months)
+        years.update(datetime.date.fromordinal(ordinal).year for ordinal in self.cells)
+        for year in years:
+            for ordinal in self.found_days(year) ^ found.get(year, set()):
+                self.cells.pop(ordinal, None)
+                date = datetime.date.fromordinal(ordinal)
+                self.months.pop((date.year, date.month), None)
+        if self.matches is None:
+            return 0
+        return self.store.matched(self.matches)
+
+    def found_days(self, year):
+        """ Return day ordinals of year with events matching query. """
+
+        if self.matches is None:
+            return set()
+        if year in self.found:
+            return self.found[year]
+        first = datetime.date(year, 1, 1).toordinal()
+        last = datetime.date(year, 12, 31).toordinal()
+        days = self.store.days(first, last, self.matches)
+        self.found[year] = days
+        return days
+
+    def heat(self, year):
+        """ Return (first day ordinal, levels, specials) of year where levels
+        are heat map levels of days (-1 when no event) and specials are the
+        numbers of special events. Computed for the whole year at once. """
+
+        if year in self.heats:
+            return self.heats[year]
+
+        first = datetime.date(year, 1, 1).toordinal()
+        last = datetime.date(year, 12, 31).toordinal()
+        loads, specials = self.store.histogram(first, last, self.weighted)
+        if self.scale == "log":
+            levels = [min(max(int(math.log2(load)), 0), 9) if load > 0 else -1
+                      for load in loads]
+        elif self.scale == "quantile":
+            # Deciles of busy days
+            busy = sorted(load for load in loads if load > 0)
+            deciles = [busy[len(busy)*i // 10] for i in range(1, 10)] if busy else []
+            levels = [bisect.bisect_left(deciles, load) if load > 0 else -1
+                      for load in loads]
+        else:
+            levels = [min(math.ceil(load)-1, 9) if load > 0 else -1 for load in loads]
+        self.heats[year] = first, levels, specials
+        return self.heats[year]
 
-        # Sort events inside a day
-        for date in self.events.keys():
-            self.events[date].sort()
+    def undefer(self, year):
+        """ Add deferred files to agenda files if year is before the year of
+        the first event (of other files) and return whether files were
+        added. Files are not parsed, this is left to the caller (populate
+        or load in background). """
+
+        if not self.deferred:
+            return False
+        first = self.store.first()
+        if first is not None and year >= datetime.date.fromordinal(first).year:
+            return False
+        self.filenames = self.filenames + self.deferred
+        self.deferred = []
+        return True
+
+    def invalidate(self, ordinals=None):
+        """ Invalidate formatted days of given day ordinals (all if None). """
+
+        if ordinals is None:
+            self.cells.clear()
+            self.months.clear()
+            self.heats.clear()
+        else:
+            # Heat of years with changed days (all days of the year
+            # with quantile scale since levels are relative)
+            for year, (first, levels, specials) in list(self.heats.items()):
+                last = first + len(levels) - 1
+                if any(first <= ordinal <= last for ordinal in ordinals):
+                    del self.heats[year]
+                    if self.scale == "quantile":
+                        ordinals = set(ordinals).union(range(first, last+1))
+            for ordinal in ordinals:
+                if self.cells.pop(ordinal, None) is not None:
+                    date = datetime.date.fromordinal(ordinal)
+                    self.months.pop((date.year, date.month), None)
+
+    def validate(self):
+        """ Invalidate formatted days if style or today changed. """
+
+        if self.style is not self.rendered_style:
+            self.rendered_style = self.style
+            self.invalidate()
+        today = datetime.date.today()
+        if today != self.today:
+            self.invalidate([self.today.toordinal(), today.toordinal()])
+            if today.year != self.today.year:
+                # Month names show year unless current one
+                self.months.clear()
+            self.today = today
 
-        
     def format_day(self, year, month, day):
         """ Format a day string (3 characters) """
-        
-        key = year, month, day
-        events = self.events.get(key, [])
-        busy = len(events)
+
+        ordinal = datetime.date(year, month, day).toordinal()
+        if ordinal in self.cells and self.style is self.rendered_style:
+            return self.cells[ordinal]
+
+        first, levels, specials = self.heat(year)
+        level, special = levels[ordinal-first], specials[ordinal-first]
+        kind = self.year_days(year)[1][ordinal-first]
         style = self.style
             
         s  = style.none
-        if self.is_today(year, month, day):
+        if ordinal == self.today.toordinal():
             s += style.today
-        elif busy > 0:
-            s += style.levels[min(busy-1,9)]
-        elif self.is_weekend(year, month, day):
+        elif level >= 0:
+            s += style.levels[level]
+        elif kind & WEEKEND:
             s += style.weekend
-        elif self.is_vacant(year, month, day):
+        elif kind & HOLIDAY:
             s += style.vacant
         else:
             s += style.default
 
-        key = year, month, day
-        events = self.events.get(key, [])
-        busy = len(events)
-        special = sum(1 for event in events if event.special)
-            
+        if ordinal in self.found_days(year):
+            s += style.match
         s += "%2d" % day
         if special > 0:
             s += style.special
@@ -230,21 +580,30 @@ class Agenda:
             s += markers[min(special,len(markers))-1]
         else:
             s += " "
-            
-        return s + style.none
 
+        s += style.none
+        self.cells[ordinal] = s
+        return s
+
+    @instrument.timed("format_month")
     def format_month(self, year, month):
         """ Format a month string (21x8 characters) """
-        
+
+        self.validate()
+        if (year, month) in self.months:
+            return self.months[year, month]
+
         day_names   = [day[:2] for day in list(calendar.day_name)]
         month_name = list(calendar.month_name)[month]
-        month_cols = 7*3
-        month_rows = 8
+        month_cols = MONTH_COLS
+        month_rows = MONTH_ROWS
         style = self.style
         
         lines = [""]*month_rows
     
-        # Month name
+        # Month name (with year, unless current one)
+        if year != self.today.year:
+            month_name += " %d" % year
         lines[0] = style.none + style.month + month_name.center(month_cols-1) + style.none + " "
     
         # Day names
@@ -262,37 +621,28 @@ class Agenda:
                     lines[2+row] += "   "
                 else:
                     lines[2+row] += self.format_day(year, month, day)
+        self.months[year, month] = lines
         return lines
 
 
     
+    @instrument.timed("display_calendar")
     def display_calendar(self, year=None):
         """ """
     
-        x0, y0 = self.origin
-        month_cols = 7*3
-        month_rows = 8
-        months_per_row = 4
         year = year or self.year
 
-        month = 1
-        for row in range(12//months_per_row):
-            for col in range(months_per_row):
-                x, y  = x0 + col*(month_cols+1) , y0 + row*(month_rows+1)
-                s = self.format_month(year, month)
-                for i in range(8):
-                    self.terminal.write(s[i], (x, y+i))
-                month += 1
-
-        self.terminal.flush()
+        for month in range(1, 13):
+            x, y = self.layout.months[month]
+            s = self.format_month(year, month)
+            for i in range(MONTH_ROWS):
+                self.terminal.write(s[i], (x, y+i))
 
 
+    @instrument.timed("display_events")
     def display_events(self, start=None):
 
         days = 1
-        month_cols = 7*3
-        month_rows = 8
-        months_per_row = 4
         style = self.style
         
         if start is None:
@@ -300,8 +650,7 @@ class Agenda:
             start = start - datetime.timedelta(days=start.weekday())
             days = 7
             
-        x = self.origin[0]
-        y = self.origin[1] + (12//months_per_row) * (month_rows+1)
+        x, y = self.layout.origin[0], self.layout.events
 
         self.terminal.clear((x,y))
         
@@ -312,21 +661,20 @@ class Agenda:
             y += 2
         else:
             s = style.event_header + "{0:%A %d %B %Y}".format(start)
-            if self.is_vacant(start.year, start.month, start.day):
-                s += style.vacant + " ({0})".format(self.holidays[start])
+            holiday = self.holiday(start)
+            if holiday is not None:
+                s += style.vacant + " ({0})".format(holiday)
                 
             self.terminal.write(s + style.none, (x,y))
             y += 2
 
         if days == 1:
-            key = start.year, start.month, start.day
-            for event in self.events.get(key,[]):
+            for event in self.day_events(start):
                 self.terminal.write(event.info(style, details=True), (x,y))
                 y += 1
         else:
             for date in (start + datetime.timedelta(days=n) for n in range(days)):
-                key = date.year, date.month, date.day
-                for i, event in enumerate(self.events.get(key,[])):
+                for i, event in enumerate(self.day_events(date)):
                     if i == 0:
                         prefix = "{0:12s} : ".format("{0:%a. %d %b.}".format(date))
                     else:
@@ -334,5 +682,3 @@ class Agenda:
                     self.terminal.write(event.info(style, details=True, prefix=prefix), (x,y))
                     y += 1
                 y += 1
-                
-        self.terminal.flush()
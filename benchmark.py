@@ -0,0 +1,217 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Benchmarks on synthetic (deterministic) org files: parse time, populate
+# time, peak memory, full calendar render time, hover to redraw latency and
+# bytes emitted, rendering into an in-memory terminal. Results can be saved
+# as a baseline (with the parser, seed and repeat settings they were made
+# with) and later checked against it, using the same settings:
+#
+#   python benchmark.py --sizes 1000 100000 --save baseline.json
+#   python benchmark.py --sizes 1000 100000 --check baseline.json
+import io
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import tempfile
+import tracemalloc
+
+import style
+from agenda import Agenda, PARSERS
+from terminal import Terminal
+from interface import Interface
+
+# Displayed year (events span a decade around it)
+YEAR = 2021
+DAYS = "Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"
+WORDS = ("meeting review call lunch project report deadline seminar "
+         "travel doctor release budget planning interview workshop").split()
+
+
+def timestamp(date, time=None, end=None):
+    """ Return an active org timestamp (with optional time or time range). """
+
+    s = "<%s %s" % (date.isoformat(), DAYS[date.weekday()])
+    if time is not None:
+        s += " %02d:%02d" % time
+        if end is not None:
+            s += "-%02d:%02d" % end
+    return s + ">"
+
+
+def generate(headings, seed=0):
+    """ Return org text with given number of headings, mixing timestamps
+    (points, time ranges, date ranges), deadlines, scheduled items and
+    plain notes. Same headings and seed always give the same text. """
+
+    rng = random.Random(seed)
+    first = datetime.date(YEAR-5, 1, 1).toordinal()
+    last = datetime.date(YEAR+4, 12, 31).toordinal()
+    lines = ["#+TITLE: Synthetic agenda (%d headings, seed %d)" % (headings, seed), ""]
+    for i in range(headings):
+        level = 1 if rng.random() < 0.3 else rng.randint(2, 3)
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize()
+        keyword = rng.choice(("", "", "TODO ", "DONE ", "NEXT "))
+        priority = "[#%s] " % rng.choice("ABC") if rng.random() < 0.1 else ""
+        tags = "   :%s:" % rng.choice(WORDS) if rng.random() < 0.2 else ""
+        date = datetime.date.fromordinal(rng.randint(first, last))
+        kind = rng.random()
+        body = []
+        if kind < 0.25:
+            title += " " + timestamp(date)
+        elif kind < 0.45:
+            hour = rng.randint(7, 19)
+            body.append(timestamp(date, (hour, rng.choice((0, 30))),
+                                  (hour+1, 0) if rng.random() < 0.5 else None))
+        elif kind < 0.55:
+            end = date + datetime.timedelta(days=rng.randint(1, 10))
+            body.append(timestamp(date) + "--" + timestamp(end))
+        elif kind < 0.70:
+            body.insert(0, "DEADLINE: " + timestamp(date))
+        elif kind < 0.80:
+            body.insert(0, "SCHEDULED: " + timestamp(date))
+        lines.append("*"*level + " " + keyword + priority + title + tags)
+        lines.extend(body)
+        if rng.random() < 0.3:
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))))
+    return "\n".join(lines) + "\n"
+
+
+def run(filename, parser="fast", repeat=3):
+    """ Run benchmarks on filename and return results as a dict. """
+
+    results = {}
+    with open(filename, encoding="utf8") as file:
+        text = file.read()
+
+    # Parse time (parser only) and populate time (read, parse and index)
+    parse = PARSERS[parser][0]
+    results["parse"] = best(repeat, lambda: parse(text, filename))
+    results["populate"] = best(repeat, lambda: Agenda([filename], {}, style.default,
+                                                      None, 1, parser))
+    # Peak memory while populating
+    tracemalloc.start()
+    agenda = Agenda([filename], {}, style.default, None, 1, parser)
+    results["memory"] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    agenda.year = YEAR
+
+    # Full calendar render (cold), into an in-memory terminal
+    def render():
+        agenda.invalidate()
+        agenda.terminal = Terminal(io.StringIO(), (100, 60))
+        agenda.display_calendar()
+        agenda.display_events(datetime.date(YEAR, 1, 1))
+        agenda.terminal.flush()
+        return agenda.terminal
+    results["render"] = best(repeat, render)
+    terminal = render()
+    results["bytes"] = terminal.bytes
+
+    # Hover latency: mouse moves from day to day over the whole calendar
+    interface = Interface(agenda, terminal)
+    positions = []
+    for y in range(1, 28):
+        for x in range(1, 88, 3):
+            if agenda.get_day((x, y))[1]:
+                positions.append((x, y))
+    means, p95s = [], []
+    for i in range(repeat):
+        latencies, emitted = [], 0
+        for position in positions:
+            start = time.perf_counter()
+            interface.hover(position)
+            terminal.flush()
+            latencies.append(time.perf_counter() - start)
+            emitted += terminal.bytes
+        latencies.sort()
+        means.append(sum(latencies) / len(latencies))
+        p95s.append(latencies[len(latencies)*95 // 100])
+    results["hover"] = min(means)
+    results["hover_p95"] = min(p95s)
+    results["hover_bytes"] = emitted // len(positions)
+    return results
+
+
+def best(repeat, function):
+    """ Return best time (in seconds) of function over repeat runs. """
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check(results, baseline, threshold):
+    """ Return regressions (size, metric, value, reference) of results
+    against baseline, i.e. values greater than reference by more than
+    threshold (ratio). """
+
+    regressions = []
+    for size, metrics in sorted(results.items(), key=lambda item: int(item[0])):
+        for metric, value in sorted(metrics.items()):
+            reference = baseline.get(size, {}).get(metric)
+            if reference is not None and value > reference * (1 + threshold):
+                regressions.append((size, metric, value, reference))
+    return regressions
+
+
+# ----------------------------------------------------------------------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Console agenda benchmarks.')
+    parser.add_argument('--sizes', type=int, nargs="+", default=[1000, 10000, 100000],
+                        help='Number of headings of synthetic files')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of synthetic files')
+    parser.add_argument('--parser', type=str, default="fast", choices=list(PARSERS),
+                        help='Parser used to read synthetic files')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs of each timing (best is kept)')
+    parser.add_argument('--save', type=str, metavar="FILE",
+                        help='Save results as baseline in FILE')
+    parser.add_argument('--check', type=str, metavar="FILE",
+                        help='Check results against baseline in FILE')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Tolerated slowdown (ratio) before reporting a regression')
+    args = parser.parse_args()
+
+    results = {}
+    units = { "parse": "s", "populate": "s", "memory": "MB", "render": "s",
+              "bytes": "B", "hover": "s", "hover_p95": "s", "hover_bytes": "B" }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            filename = os.path.join(directory, "agenda-%d.org" % size)
+            with open(filename, "w", encoding="utf8") as file:
+                file.write(generate(size, args.seed))
+            results[str(size)] = run(filename, args.parser, args.repeat)
+            print("%d headings:" % size)
+            for metric, value in results[str(size)].items():
+                print("  %-12s %12.6g %s" % (metric, value, units[metric]))
+
+    settings = { "parser": args.parser, "seed": args.seed, "repeat": args.repeat }
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({ "settings": settings, "results": results }, file,
+                      indent=2, sort_keys=True)
+    if args.check:
+        with open(args.check) as file:
+            baseline = json.load(file)
+        if baseline.get("settings") != settings:
+            describe = lambda settings: ", ".join("%s=%s" % item for item in
+                                                  sorted(settings.items()))
+            parser.error("baseline %s was made with %s, not %s" % (
+                args.check, describe(baseline["settings"]) if "settings" in baseline
+                             else "unknown settings", describe(settings)))
+        regressions = check(results, baseline["results"], args.threshold)
+        for size, metric, value, reference in regressions:
+            increase = "+%d%%" % (100*(value/reference - 1)) if reference else "was 0"
+            print("Regression (%s headings): %s is %.6g instead of %.6g (%s)" % (
+                size, metric, value, reference, increase))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,144 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+import os
+import pickle
+import hashlib
+import tempfile
+
+# Bump whenever the layout of cache entries changes
+VERSION = 1
+
+
+class Cache:
+    """ On-disk cache of parsed events, one entry per agenda file.
+
+    Each entry holds the file stamp (mtime, size), the content digest and
+    the event records extracted by the parser. An entry is only used if
+    cache version, parser version, path and stamp all match; anything
+    else (missing, stale or corrupt entry) is reported as a miss.
+
+    Holiday tables are cached as well, one entry per country and year. """
+
+    def __init__(self, path=None):
+        """ Create a cache in path (default is $XDG_CACHE_HOME/agenda). """
+
+        if path is None:
+            path = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            path = os.path.join(path, "agenda")
+        self.path = path
+
+    def entry(self, filename):
+        """ Return the cache entry path for filename. """
+
+        filename = os.path.abspath(filename)
+        return os.path.join(self.path, hashlib.sha1(filename.encode()).hexdigest())
+
+    def read(self, path):
+        """ Return the entry stored in path or None if missing or corrupt. """
+
+        try:
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        except Exception:
+            return None
+
+    def write(self, path, entry):
+        """ Store entry in path (errors are silently ignored). """
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(entry, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+
+    def get(self, filename, stamp, parser):
+        """ Return (digest, records) for filename or None if not cached. """
+
+        try:
+            version, path, entry_parser, entry_stamp, digest, records = self.read(self.entry(filename))
+        except (TypeError, ValueError):
+            return None
+        if (version != VERSION or path != os.path.abspath(filename)
+            or entry_parser != parser or entry_stamp != stamp):
+            return None
+        return digest, records
+
+    def set(self, filename, stamp, parser, digest, records):
+        """ Store records for filename (errors are silently ignored). """
+
+        entry = VERSION, os.path.abspath(filename), parser, stamp, digest, records
+        self.write(self.entry(filename), entry)
+
+    def holidays_entry(self, country, year):
+        """ Return the cache entry path for holidays of country in year. """
+
+        key = "holidays:%r:%d" % (country, year)
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def get_holidays(self, country, year):
+        """ Return holiday names (day ordinal -> name) of country in year
+        or None if not cached. Country is any (printable) key identifying
+        the holiday calendar. """
+
+        try:
+            version, entry_country, entry_year, names = self.read(self.holidays_entry(country, year))
+        except (TypeError, ValueError):
+            return None
+        if version != VERSION or entry_country != country or entry_year != year:
+            return None
+        return names
+
+    def set_holidays(self, country, year, names):
+        """ Store holiday names of country in year (errors are silently ignored). """
+
+        self.write(self.holidays_entry(country, year), (VERSION, country, year, names))
+
+
+class MemoryCache:
+    """ In-memory cache of parsed events and holidays, in front of an
+    (optional) on-disk cache, such that agendas sharing files within a
+    process only read and parse them once. """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.entries = {}
+
+    def get(self, filename, stamp, parser):
+        """ Return (digest, records) for filename or None if not cached. """
+
+        key = os.path.abspath(filename), stamp, parser
+        if key not in self.entries and self.cache is not None:
+            entry = self.cache.get(filename, stamp, parser)
+            if entry is not None:
+                self.entries[key] = entry
+        return self.entries.get(key)
+
+    def set(self, filename, stamp, parser, digest, records):
+        """ Store records for filename. """
+
+        self.entries[os.path.abspath(filename), stamp, parser] = digest, records
+        if self.cache is not None:
+            self.cache.set(filename, stamp, parser, digest, records)
+
+    def get_holidays(self, country, year):
+        """ Return holiday names of country in year or None if not cached. """
+
+        key = "holidays", country, year
+        if key not in self.entries and self.cache is not None:
+            names = self.cache.get_holidays(country, year)
+            if names is not None:
+                self.entries[key] = names
+        return self.entries.get(key)
+
+    def set_holidays(self, country, year, names):
+        """ Store holiday names of country in year. """
+
+        self.entries["holidays", country, year] = names
+        if self.cache is not None:
+            self.cache.set_holidays(country, year, names)
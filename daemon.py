@@ -0,0 +1,326 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Agenda daemon: a server keeps parsed (and watched) event stores resident
+# and answers queries (day range records, year histograms, searches) of
+# thin clients over a local Unix socket, such that every session shares a
+# single parse and starts at once. The protocol is made of JSON lines: a
+# request is an object with an "op" name and arguments, a response is an
+# object with either a "result" or an "error". Dates are day ordinals and
+# minutes (-1 if no time) and records are flat lists.
+import os
+import json
+import stat
+import signal
+import socket
+import asyncio
+import threading
+
+import style
+from index import split, join
+from agenda import Agenda
+
+
+def path():
+    """ Return default socket path (in $XDG_RUNTIME_DIR, in a private
+    directory of /tmp if unset). """
+
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if directory:
+        return os.path.join(directory, "agenda-%d.sock" % os.getuid())
+    return os.path.join("/tmp", "agenda-%d" % os.getuid(), "agenda.sock")
+
+
+def check(path):
+    """ Raise PermissionError unless path (socket or its directory) is
+    owned by the user and not writable by others. Sticky directories
+    (such as /tmp) are accepted since others cannot replace files. """
+
+    info = os.stat(path)
+    if stat.S_ISDIR(info.st_mode) and info.st_mode & stat.S_ISVTX:
+        return
+    if info.st_uid != os.getuid():
+        raise PermissionError("%s is owned by another user" % path)
+    if info.st_mode & 0o022:
+        raise PermissionError("%s is writable by other users" % path)
+
+
+def encode(record):
+    """ Return a record as a flat list. """
+
+    description, start, end, special, repeat, tags = record
+    start_day, start_minute = split(start)
+    end_day, end_minute = split(end) if end is not None else (None, None)
+    return [description, start_day, start_minute, end_day, end_minute,
+            special, repeat, tags]
+
+
+def decode(item):
+    """ Return a record from a flat list. """
+
+    description, start_day, start_minute, end_day, end_minute, special, repeat, tags = item
+    end = join(end_day, end_minute) if end_day is not None else None
+    return (description, join(start_day, start_minute), end, special,
+            tuple(repeat) if repeat is not None else None, tuple(tags))
+
+
+class Server:
+    """ Agenda daemon serving event stores of sets of files (one agenda
+    per set of files and parser), reloading them whenever files change.
+    Each store has a generation number, incremented when events change,
+    that clients poll in order to know when to redraw. Polling never
+    waits for a reload (files are only reloaded when opened and by the
+    watcher). """
+
+    def __init__(self, path, cache=None, jobs=1, interval=1.0):
+        """ Build a server listening on path, using the (optional) cache
+        of parsed events and parsing files with jobs processes. Files are
+        checked for modifications every interval seconds. """
+
+        self.path = path
+        self.cache = cache
+        self.jobs = jobs
+        self.interval = interval
+        self.agendas = []   # id -> [agenda, generation, lock]
+        self.ids = {}       # (files, parser, skip) -> id
+        self.listening = False
+
+    def run(self):
+        """ Run the server until interrupted (or terminated). """
+
+        try:
+            asyncio.run(self.main())
+        finally:
+            if self.listening:
+                os.unlink(self.path)
+
+    async def main(self):
+        # Private directory (created if needed) and socket of the user only
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+        try:
+            check(directory)
+            if os.path.exists(self.path):
+                check(self.path)
+        except PermissionError as error:
+            raise RuntimeError(str(error)) from error
+
+        # Remove socket of a dead server (refuse to replace a live one)
+        if os.path.exists(self.path):
+            try:
+                Client(self.path).close()
+            except ConnectionError:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError("A server is already listening on %s" % self.path)
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.serve, path=self.path)
+        finally:
+            os.umask(umask)
+        self.listening = True
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        async with server:
+            watcher = loop.create_task(self.watch()) if self.interval else None
+            await stop
+            if watcher:
+                watcher.cancel()
+
+    async def serve(self, reader, writer):
+        """ Answer requests of a client until it disconnects. """
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    response = { "result": await self.answer(**request) }
+                except Exception as error:
+                    response = { "error": "%s: %s" % (type(error).__name__, error) }
+                writer.write(json.dumps(response, separators=(",", ":")).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, op, id=None, **args):
+        """ Return result of operation op on agenda id. """
+
+        if op == "open":
+            return await self.open(args["files"], args.get("parser", "orgparse"),
+                                   args.get("skip", False))
+        agenda, generation, lock = self.agendas[id]
+        store = agenda.store
+        if op == "generation":
+            return self.agendas[id][1]
+        if op == "records":
+            matches = store.search(args["query"]) if args.get("query") else None
+            return [encode(record) for record in store.records(args["start"], args["end"],
+                                                               matches)]
+        if op == "histogram":
+            return store.histogram(args["first"], args["last"], args.get("weighted", False))
+        if op == "search":
+            matches = store.search(args["query"])
+            return store.matched(matches) if matches is not None else None
+        if op == "days":
+            return sorted(store.days(args["first"], args["last"], store.search(args["query"])))
+        raise ValueError("Unknown operation %r" % op)
+
+    async def open(self, files, parser, skip=False):
+        """ Return (id, generation) of agenda of files (loaded if necessary). """
+
+        key = tuple(os.path.abspath(filename) for filename in files), parser, skip
+        if key not in self.ids:
+            loop = asyncio.get_running_loop()
+            agenda = await loop.run_in_executor(None, lambda: Agenda(
+                list(key[0]), {}, style.default, self.cache, self.jobs, parser,
+                skip=skip))
+            if key not in self.ids:
+                self.ids[key] = len(self.agendas)
+                self.agendas.append([agenda, 0, asyncio.Lock()])
+        id = self.ids[key]
+        await self.reload(id)
+        return id, self.agendas[id][1]
+
+    async def reload(self, id):
+        """ Reload agenda id (parsing in a worker thread) if files changed. """
+
+        agenda, generation, lock = self.agendas[id]
+        async with lock:
+            if not agenda.modified():
+                return
+            patch = await asyncio.get_running_loop().run_in_executor(None, agenda.load)
+            if agenda.merge(patch):
+                self.agendas[id][1] += 1
+
+    async def watch(self):
+        """ Reload agendas whenever a file is modified. """
+
+        while True:
+            await asyncio.sleep(self.interval)
+            for id in range(len(self.agendas)):
+                await self.reload(id)
+
+
+class Client:
+    """ Connection to an agenda server (thread safe). """
+
+    def __init__(self, path):
+        """ Connect to server listening on path (ConnectionError if none,
+        PermissionError if socket does not belong to the user). """
+
+        try:
+            check(os.path.dirname(os.path.abspath(path)))
+            check(path)
+        except FileNotFoundError as error:
+            raise ConnectionError("No agenda server on %s" % path) from error
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as error:
+            self.socket.close()
+            raise ConnectionError("No agenda server on %s" % path) from error
+        self.file = self.socket.makefile("rwb")
+        self.lock = threading.Lock()
+
+    def request(self, op, **args):
+        """ Send request and return its result. """
+
+        with self.lock:
+            self.file.write(json.dumps(dict(op=op, **args), separators=(",", ":")).encode()
+                            + b"\n")
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            raise ConnectionError("Agenda server closed connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class RemoteStore:
+    """ Event store of an agenda server (same query interface as
+    EventStore). Search matches are (query, number of events). """
+
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
+
+    def records(self, start, end, matches=None):
+        return [decode(item) for item in self.client.request(
+            "records", id=self.id, start=start, end=end,
+            query=matches[0] if matches is not None else None)]
+
+    def histogram(self, first, last, weighted=False):
+        return self.client.request("histogram", id=self.id, first=first, last=last,
+                                   weighted=weighted)
+
+    def search(self, query):
+        count = self.client.request("search", id=self.id, query=query)
+        return (query, count) if count is not None else None
+
+    def matched(self, matches):
+        return matches[1]
+
+    def days(self, first, last, matches):
+        return set(self.client.request("days", id=self.id, first=first, last=last,
+                                       query=matches[0]))
+
+
+class RemoteAgenda(Agenda):
+    """ Agenda whose events are held by an agenda server: files are
+    neither parsed nor watched by the agenda itself, it only asks the
+    server whether events changed (generation). Archive files are never
+    deferred since the server parses them only once for all clients. """
+
+    def __init__(self, client, filenames, holidays, style, parser="orgparse",
+                 scale="linear", weighted=False, skip=False, defer=False):
+        """ Build an agenda of given files using client connection. """
+
+        self.client = client
+        self.generation = None
+        self.skip = skip
+        Agenda.__init__(self, filenames, holidays, style, None, 1, parser, scale, weighted)
+
+    def populate(self):
+        id, self.generation = self.client.request("open", files=self.filenames,
+                                                  parser=self.parser[0], skip=self.skip)
+        self.store = RemoteStore(self.client, id)
+        self.invalidate()
+        return True
+
+    def modified(self):
+        # Server is only asked by load (in background) since asking here
+        # would block the interface
+        return True
+
+    def load(self):
+        return self.client.request("generation", id=self.store.id)
+
+    def merge(self, patch):
+        if patch == self.generation:
+            return set()
+        self.generation = patch
+        self.invalidate()
+        if self.query:
+            self.search(self.query)
+        return True
+
+
+# ----------------------------------------------------------------------
+if __name__ == "__main__":
+    from cache import Cache
+
+    Server(path(), Cache()).run()
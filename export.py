@@ -0,0 +1,160 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Non-interactive rendering of agendas: year calendar and events of a range
+# of dates, as ANSI text, plain text or JSON lines. Renderers are generators
+# of lines such that output is streamed, and many snapshots (agenda sets)
+# can be rendered in a single process, parsing each file only once.
+import io
+import sys
+import json
+import datetime
+
+import style
+from agenda import Agenda, WEEKEND
+from cache import MemoryCache
+from layout import Layout
+from daemon import RemoteAgenda
+from terminal import Terminal
+
+FORMATS = "ansi", "text", "json"
+
+
+def render_calendar(agenda, year=None, format="ansi"):
+    """ Iterate over lines of the calendar of year (default is agenda year).
+    JSON lines describe days (date, events, specials, level, weekend and
+    holiday). """
+
+    year = year or agenda.year
+    if agenda.undefer(year):
+        agenda.populate()
+    if format == "json":
+        first, levels, specials = agenda.heat(year)
+        first, kinds, names = agenda.year_days(year)
+        counts, _ = agenda.store.histogram(first, first + len(levels) - 1)
+        for i, level in enumerate(levels):
+            yield json.dumps({ "date": datetime.date.fromordinal(first+i).isoformat(),
+                               "events": counts[i],
+                               "specials": specials[i],
+                               "level": level,
+                               "weekend": bool(kinds[i] & WEEKEND),
+                               "holiday": names.get(first+i) })
+        return
+
+    # Render into an in-memory terminal (4x3 months)
+    layout = Layout()
+    terminal = Terminal(io.StringIO(), (layout.width+1, layout.height))
+    previous = agenda.terminal, agenda.layout
+    agenda.terminal, agenda.layout = terminal, layout
+    try:
+        agenda.display_calendar(year)
+    finally:
+        agenda.terminal, agenda.layout = previous
+    yield from terminal.lines(ansi=(format == "ansi"))
+
+
+def render_events(agenda, start, end, format="ansi"):
+    """ Iterate over lines listing events from start to end dates (day by
+    day, as in the weekly display). JSON lines describe events (each event
+    only once). """
+
+    if agenda.undefer(start.year):
+        agenda.populate()
+    if format == "json":
+        for event in agenda.range_events(start, end):
+            yield json.dumps({ "description": event.description,
+                               "start": isoformat(event.start_date, event.start_time),
+                               "end": isoformat(event.end_date, event.end_time),
+                               "special": event.special })
+        return
+
+    date = start
+    while date <= end:
+        for i, event in enumerate(agenda.day_events(date)):
+            if i == 0:
+                prefix = "{0:12s} : ".format("{0:%a. %d %b.}".format(date))
+            else:
+                prefix = " "*15
+            line = event.info(agenda.style, details=True, prefix=prefix)
+            yield line if format == "ansi" else style.SGR.sub("", line)
+        date += datetime.timedelta(days=1)
+
+
+def isoformat(date, time=None):
+    """ Return ISO representation of date and (optional) time. """
+
+    if date is None:
+        return None
+    if time is None:
+        return date.isoformat()
+    return datetime.datetime.combine(date, time).isoformat()
+
+
+def render(agenda, format="ansi", year=None, start=None, end=None, calendar=True):
+    """ Iterate over lines of calendar of year (unless calendar is False)
+    followed by events from start to end (if given). """
+
+    if calendar:
+        yield from render_calendar(agenda, year, format)
+    if start is not None:
+        if calendar and format != "json":
+            yield ""
+        yield from render_events(agenda, start, end or start, format)
+
+
+def write(lines, output="-"):
+    """ Write lines to output filename (standard output if "-"). """
+
+    file = sys.stdout if output == "-" else open(output, "w", encoding="utf8")
+    try:
+        for line in lines:
+            file.write(line + "\n")
+    finally:
+        if file is not sys.stdout:
+            file.close()
+
+
+def batch(snapshots, cache=None, client=None, **defaults):
+    """ Render snapshots, each of them being a dict of options (files,
+    output, format, year, start, end, calendar, holidays, style, colors,
+    parser, scale, weighted, skip, defer) where missing options are taken
+    from defaults. Parsed files and holidays are shared by all snapshots
+    and agendas are reused by snapshots of the same files (with same
+    options). Events are queried from an agenda server if a client
+    connection is given. """
+
+    import holidays
+
+    cache = MemoryCache(cache)
+    countries, styles, agendas = {}, {}, {}
+    for snapshot in snapshots:
+        options = dict(defaults, **snapshot)
+        country = options.get("holidays", "France")
+        if country not in countries:
+            countries[country] = getattr(holidays, country)()
+        key = options.get("style", "default"), options.get("colors", "truecolor")
+        if key not in styles:
+            styles[key] = style.compile(getattr(style, key[0]),
+                                        style.depth() if key[1] == "auto" else key[1])
+        arguments = (tuple(options["files"]), country, key, options.get("jobs", 1),
+                     options.get("parser", "orgparse"), options.get("scale", "linear"),
+                     options.get("weighted", False), options.get("skip", False),
+                     options.get("defer", False))
+        if arguments not in agendas and client is not None:
+            agendas[arguments] = RemoteAgenda(client, list(arguments[0]), countries[country],
+                                              styles[key], *arguments[4:])
+        elif arguments not in agendas:
+            agendas[arguments] = Agenda(list(arguments[0]), countries[country], styles[key],
+                                        cache, *arguments[3:])
+        agenda = agendas[arguments]
+        write(render(agenda, options.get("format", "ansi"), options.get("year"),
+                     parse_date(options.get("start")), parse_date(options.get("end")),
+                     options.get("calendar", True)), options.get("output", "-"))
+
+
+def parse_date(value):
+    """ Return date from ISO string (or date, or None). """
+
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
@@ -0,0 +1,607 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+import os
+import re
+import bisect
+import calendar
+import datetime
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class EventStore:
+    """ Compact columnar store of agenda events.
+
+    Events are kept in array columns sorted by start (day ordinal, then
+    minutes, then source): start and end day ordinals, start and end
+    minutes (-1 when there is no time), flags (special, has an end), index
+    of description in a table of unique descriptions, index of tags in a
+    table of unique tag sets and source (file) id. Records (and events)
+    are only built when queried. Tables only grow (entries are shared by
+    files and kept when they are reparsed).
+
+    Sorted columns are also seen as an implicit balanced binary tree (the
+    middle of a slice is the root of the slice, the whole slice being a
+    power of two larger than the number of rows) where each node stores
+    the maximum end of its subtree (maxends), such that events starting
+    before a day and overlapping it are found in O(log n + k), while
+    events starting within a range of days are found by bisection. Since
+    the tree keeps its shape when rows are added or removed, subtrees
+    before the first changed row are left untouched.
+
+    Repeating events (org repeaters "+", "++" and ".+", all displayed the
+    same way) are not materialized but kept as rules, whose occurrences
+    are only computed for queried windows of days (and cached).
+
+    Every event (row or rule) has a unique id, kept when rows move. An
+    inverted index maps (lowercase) words of descriptions, tags and file
+    names to ids of events, per source such that only words of changed
+    files are updated. Words are sorted such that events whose words
+    start with a prefix are found by bisection. """
+
+    SPECIAL = 1
+    END = 2
+
+    def __init__(self):
+        self.starts = array("l")
+        self.ends = array("l")
+        self.start_minutes = array("h")
+        self.end_minutes = array("h")
+        self.flags = array("B")
+        self.descriptions = array("l")
+        self.tags = array("l")
+        self.sources = array("I")
+        self.uids = array("l")
+        self.maxends = array("l")
+        self.capacity = 1     # size of the implicit tree (power of two)
+        self.strings = []     # unique descriptions
+        self.tagsets = []     # unique tag sets
+        self.string_ids = {}  # description -> index in strings
+        self.tagset_ids = {}  # tag set -> index in tagsets
+        self.ids = {}         # filename -> source id
+        self.spans = {}       # source id -> start days of its rows
+        self.rules = []       # repeating events
+        self.windows = {}     # (first, last) -> occurrences of rules
+        self.uid = 0          # next event id
+        self.extents = {}     # event id -> (start day, end day) of rows
+        self.words = []       # sorted words of the inverted index
+        self.postings = {}    # word -> source id -> event ids
+        self.vocabulary = {}  # source id -> words of its events
+        self.searches = {}    # query words -> event ids
+
+    def __len__(self):
+        return len(self.starts)
+
+    def update(self, removed=(), added=None):
+        """ Remove events of removed files and replace events of added
+        files (filename -> records) and return changed day ordinals (None
+        if any day may have changed, i.e. repeating events changed).
+
+        Only rows of changed files are touched: they are found day by day,
+        new rows (sorted) are merged in between kept ones and the maximum
+        ends are only computed again for the slice of changed (or moved)
+        rows. """
+
+        added = added or {}
+        changed = set()
+        ids = set(self.ids[filename] for filename in list(removed) + list(added)
+                                     if filename in self.ids)
+        for filename in added:
+            self.ids.setdefault(filename, len(self.ids))
+
+        # Repeating events
+        rules = [rule for rule in self.rules if rule[6] not in ids]
+        old = sorted(rule[:9] for rule in self.rules if rule[6] in ids)
+        new = []
+
+        # New rows as sorted (start day, start minute, source, ...) tuples
+        rows = []
+        for filename, records in added.items():
+            source = self.ids[filename]
+            for description, start, end, special, repeat, tagset in records:
+                start_day, start_minute = split(start)
+                flag = self.SPECIAL if special else 0
+                if end is not None:
+                    end_day, end_minute = split(end)
+                    end_day = max(end_day, start_day)
+                    flag |= self.END
+                else:
+                    end_day, end_minute = start_day, -1
+                self.uid += 1
+                if repeat is not None:
+                    new.append((start_day, start_minute, end_day, end_minute, flag,
+                                description, source, tuple(repeat), tuple(tagset), self.uid))
+                    continue
+                rows.append((start_day, start_minute, source, end_day, end_minute, flag,
+                             self._string(description), self._tagset(tuple(tagset)),
+                             self.uid))
+                self.extents[self.uid] = start_day, end_day
+                changed.update(range(start_day, end_day+1))
+        rows.sort(key=lambda row: row[:3])
+
+        # Dropped rows (rows of a source are searched among rows of its days)
+        dropped = []
+        for source in ids:
+            for day in sorted(set(self.spans.pop(source, ()))):
+                lo = bisect.bisect_left(self.starts, day)
+                hi = bisect.bisect_right(self.starts, day, lo)
+                dropped.extend(row for row in range(lo, hi) if self.sources[row] == source)
+        dropped.sort()
+        for row in dropped:
+            changed.update(range(self.starts[row], self.ends[row]+1))
+            del self.extents[self.uids[row]]
+        for source in set(row[2] for row in rows):
+            self.spans[source] = array("l", (row[0] for row in rows if row[2] == source))
+
+        # Merge kept rows (copied by slices) and new rows
+        positions = [self._position(*row[:3]) for row in rows]
+        columns = (self.starts, self.start_minutes, self.sources, self.ends,
+                   self.end_minutes, self.flags, self.descriptions, self.tags, self.uids)
+        merged = [array(column.typecode) for column in columns]
+        cursor, i, j = 0, 0, 0
+        first, last = None, None   # first and last changed rows (new ones)
+        while i < len(dropped) or j < len(rows):
+            insert = j < len(rows) and (i == len(dropped) or positions[j] <= dropped[i])
+            position = positions[j] if insert else dropped[i]
+            if position > cursor:
+                for column, values in zip(merged, columns):
+                    column.extend(values[cursor:position])
+                cursor = position
+            last = len(merged[0])
+            if first is None:
+                first = last
+            if insert:
+                for column, value in zip(merged, rows[j]):
+                    column.append(value)
+                j += 1
+            else:
+                cursor = position + 1
+                i += 1
+        for column, values in zip(merged, columns):
+            column.extend(values[cursor:])
+        if len(dropped) != len(rows):
+            # Rows after last change have moved
+            last = len(merged[0])
+        (self.starts, self.start_minutes, self.sources, self.ends,
+         self.end_minutes, self.flags, self.descriptions, self.tags, self.uids) = merged
+
+        # Maximum ends of the implicit tree, over changed rows only
+        capacity = 1
+        while capacity < len(self.starts):
+            capacity *= 2
+        if capacity != self.capacity:
+            self.capacity, first, last = capacity, 0, len(self.starts)
+        if first is not None:
+            maxends = self.maxends[:len(self.starts)]
+            maxends.extend(array("l", [0]) * (len(self.starts) - len(maxends)))
+            self.maxends = maxends
+            self._build(0, self.capacity, first, last)
+
+        new.sort()
+        self.rules = rules + new
+        self.windows.clear()
+        self._index(ids, rows, new)
+        if old != [rule[:9] for rule in new]:
+            return None
+        return changed
+
+    def _position(self, start_day, start_minute, source):
+        """ Return row before which an event of given key is inserted. """
+
+        lo = bisect.bisect_left(self.starts, start_day)
+        hi = bisect.bisect_right(self.starts, start_day, lo)
+        while lo < hi and (self.start_minutes[lo], self.sources[lo]) <= (start_minute, source):
+            lo += 1
+        return lo
+
+    def _string(self, description):
+        """ Return index of description in the table of descriptions. """
+
+        index = self.string_ids.get(description)
+        if index is None:
+            index = self.string_ids[description] = len(self.strings)
+            self.strings.append(description)
+        return index
+
+    def _tagset(self, tagset):
+        """ Return index of tag set in the table of tag sets. """
+
+        index = self.tagset_ids.get(tagset)
+        if index is None:
+            index = self.tagset_ids[tagset] = len(self.tagsets)
+            self.tagsets.append(tagset)
+        return index
+
+    def _index(self, ids, rows, rules):
+        """ Update inverted index: remove words of changed sources (ids) and
+        add words of their new rows and rules. """
+
+        postings, removed, added = self.postings, set(), set()
+        for source in ids:
+            for word in self.vocabulary.pop(source, ()):
+                del postings[word][source]
+                if not postings[word]:
+                    del postings[word]
+                    removed.add(word)
+
+        names = { source: filename for filename, source in self.ids.items() }
+        cache = {}
+        items = [(row[2], self.strings[row[6]], self.tagsets[row[7]], row[8]) for row in rows]
+        items += [(rule[6], rule[5], rule[8], rule[9]) for rule in rules]
+        for source, description, tags, uid in items:
+            key = source, description, tags
+            words = cache.get(key)
+            if words is None:
+                words = cache[key] = self._words(description, tags, names[source])
+                self.vocabulary.setdefault(source, set()).update(words)
+            for word in words:
+                sources = postings.get(word)
+                if sources is None:
+                    sources = postings[word] = {}
+                    added.add(word)
+                if source not in sources:
+                    sources[source] = array("l")
+                sources[source].append(uid)
+
+        # Sorted words (only changed if words appeared or disappeared)
+        gone, new = removed - added, added - removed
+        if gone:
+            self.words = [word for word in self.words if word not in gone]
+        if new:
+            self.words.extend(new)
+            self.words.sort()
+        self.searches = {}
+
+    @staticmethod
+    def _words(description, tags, filename):
+        """ Return words of an event (description, tags and file name). """
+
+        words = set(tokenize(description))
+        for tag in tags:
+            words.update(tokenize(tag))
+        words.update(tokenize(os.path.basename(filename)))
+        return words
+
+    def search(self, query):
+        """ Return ids of events matching all words of query, last word
+        being a prefix (such that search can be incremental), None if
+        query has no word. """
+
+        words = tuple(tokenize(query))
+        if not words:
+            return None
+        if words in self.searches:
+            return self.searches[words]
+
+        # Previous words must match exactly, last one is a prefix
+        matches = None
+        for i, word in enumerate(words):
+            if i < len(words)-1:
+                lo = bisect.bisect_left(self.words, word)
+                hi = lo + (lo < len(self.words) and self.words[lo] == word)
+            else:
+                lo = bisect.bisect_left(self.words, word)
+                hi = bisect.bisect_left(self.words, word + "\uffff", lo)
+            found = set()
+            for index in range(lo, hi):
+                for uids in self.postings[self.words[index]].values():
+                    found.update(uids)
+            matches = found if matches is None else matches & found
+        if len(self.searches) > 256:
+            self.searches.clear()
+        self.searches[words] = matches
+        return matches
+
+    def first(self):
+        """ Return first day ordinal with an event (None if no event). """
+
+        days = [rule[0] for rule in self.rules]
+        if len(self.starts):
+            days.append(self.starts[0])
+        return min(days) if days else None
+
+    def matched(self, matches):
+        """ Return number of events of search matches. """
+
+        return len(matches)
+
+    def days(self, first, last, matches):
+        """ Return set of day ordinals (from first to last) with events of
+        search matches. """
+
+        days = set()
+        for uid in matches:
+            extent = self.extents.get(uid)
+            if extent is not None and extent[0] <= last and extent[1] >= first:
+                days.update(range(max(extent[0], first), min(extent[1], last)+1))
+        for occurrence in self.occurrences(first, last):
+            if occurrence[-1] in matches:
+                days.update(range(max(occurrence[0], first), min(occurrence[2], last)+1))
+        return days
+
+    def _build(self, left, right, first, last):
+        """ Compute maximum end of the subtree rooted in the middle of [left,
+        right[ where only rows from first to last changed (other subtrees
+        are left untouched) """
+
+        if left >= min(right, len(self.starts)):
+            return None
+        middle = (left + right) // 2
+        if middle >= len(self.starts):
+            return self._build(left, middle, first, last)
+        if right <= first or left > last:
+            return self.maxends[middle]
+        maxend = self.ends[middle]
+        for end in (self._build(left, middle, first, last),
+                    self._build(middle+1, right, first, last)):
+            if end is not None and end > maxend:
+                maxend = end
+        self.maxends[middle] = maxend
+        return maxend
+
+    def rows(self, start, end):
+        """ Return rows of events overlapping [start, end] day ordinals. """
+
+        # Events starting before start (tree), then events starting
+        # within [start, end] (contiguous rows)
+        rows = []
+        self._overlap(0, self.capacity, start, rows)
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_right(self.starts, end, lo)
+        rows.extend(range(lo, hi))
+        return rows
+
+    def _overlap(self, left, right, start, rows):
+        """ Collect rows of events starting before start and ending after. """
+
+        if left >= min(right, len(self.starts)):
+            return
+        middle = (left + right) // 2
+        if middle >= len(self.starts):
+            self._overlap(left, middle, start, rows)
+            return
+        if self.maxends[middle] < start:
+            return
+        self._overlap(left, middle, start, rows)
+
+        # Events on the right start even later
+        if self.starts[middle] >= start:
+            return
+        if self.ends[middle] >= start:
+            rows.append(middle)
+        self._overlap(middle+1, right, start, rows)
+
+    def record(self, row):
+        """ Return (description, start, end, special, repeat, tags) record of given row. """
+
+        start = join(self.starts[row], self.start_minutes[row])
+        end = None
+        if self.flags[row] & self.END:
+            end = join(self.ends[row], self.end_minutes[row])
+        return (self.strings[self.descriptions[row]], start, end,
+                bool(self.flags[row] & self.SPECIAL), None, self.tagsets[self.tags[row]])
+
+    def occurrences(self, first, last):
+        """ Return occurrences of repeating events overlapping days first to
+        last (day ordinals) as (start day, start minute, end day, end minute,
+        flags, description, source, repeat, tags, event id) tuples. """
+
+        key = first, last
+        if key not in self.windows:
+            if len(self.windows) > 256:
+                self.windows.clear()
+            occurrences = []
+            for rule in self.rules:
+                for occurrence in expand(rule[:4], rule[7], first, last):
+                    occurrences.append(occurrence + rule[4:])
+            self.windows[key] = occurrences
+        return self.windows[key]
+
+    def records(self, start, end, matches=None):
+        """ Return sorted records of events (including occurrences of
+        repeating events) overlapping [start, end] day ordinals, only
+        keeping search matches (event ids) if given. """
+
+        rows = self.rows(start, end)
+        if matches is not None:
+            rows = [row for row in rows if self.uids[row] in matches]
+        items = [((self.starts[row], self.start_minutes[row], self.sources[row]),
+                  self.record(row)) for row in rows]
+        for start_day, start_minute, end_day, end_minute, flags, description, source, \
+            repeat, tags, uid in self.occurrences(start, end):
+            if matches is not None and uid not in matches:
+                continue
+            items.append(((start_day, start_minute, source),
+                          (description, join(start_day, start_minute),
+                           join(end_day, end_minute) if flags & self.END else None,
+                           bool(flags & self.SPECIAL), repeat, tags)))
+        if len(items) > 1 and self.rules:
+            items.sort(key=lambda item: item[0])
+        return [record for key, record in items]
+
+    def histogram(self, first, last, weighted=False):
+        """ Return per-day number of events and of special events for days
+        first to last (day ordinals), an event counting on every day it
+        spans. If weighted, events are weighted by their duration in hours
+        (for timed events within a day, 1 otherwise). """
+
+        size = last - first + 1
+        counts, specials = [0]*(size+1), [0]*(size+1)
+        def add(start_day, end_day, start_minute, end_minute, flags):
+            start = max(start_day, first) - first
+            end = min(end_day, last) - first + 1
+            weight = 1
+            if weighted and start+1 == end and 0 <= start_minute < end_minute:
+                weight = (end_minute - start_minute) / 60
+            counts[start] += weight
+            counts[end] -= weight
+            if flags & self.SPECIAL:
+                specials[start] += 1
+                specials[end] -= 1
+
+        # Occurrences of repeating events (always in python)
+        for start_day, start_minute, end_day, end_minute, flags, *rest \
+            in self.occurrences(first, last):
+            add(start_day, end_day, start_minute, end_minute, flags)
+
+        hi = bisect.bisect_right(self.starts, last)
+        if numpy is not None:
+            starts = numpy.frombuffer(self.starts, dtype=self.starts.typecode)[:hi]
+            ends = numpy.frombuffer(self.ends, dtype=self.ends.typecode)[:hi]
+            flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)[:hi]
+            rows = numpy.nonzero(ends >= first)[0]
+            starts = numpy.maximum(starts[rows], first) - first
+            ends = numpy.minimum(ends[rows], last) - first + 1
+            weights = None
+            if weighted:
+                weights = numpy.ones(len(rows))
+                start_minutes = numpy.frombuffer(self.start_minutes, dtype=numpy.int16)[rows]
+                end_minutes = numpy.frombuffer(self.end_minutes, dtype=numpy.int16)[rows]
+                timed = (starts+1 == ends) & (start_minutes >= 0) & (end_minutes > start_minutes)
+                weights[timed] = (end_minutes[timed] - start_minutes[timed]) / 60
+            special = (flags[rows] & self.SPECIAL) != 0
+            counts = numpy.cumsum(numpy.bincount(starts, weights, size+1)
+                                - numpy.bincount(ends, weights, size+1) + counts)[:size]
+            specials = numpy.cumsum(numpy.bincount(starts[special], None, size+1)
+                                  - numpy.bincount(ends[special], None, size+1) + specials)[:size]
+            if weighted:
+                counts = counts.round(6)
+            return counts.tolist(), specials.tolist()
+
+        # Pure python fallback
+        for row in self.rows(first, last):
+            add(self.starts[row], self.ends[row], self.start_minutes[row],
+                self.end_minutes[row], self.flags[row])
+        for i in range(1, size):
+            counts[i] += counts[i-1]
+            specials[i] += specials[i-1]
+        if weighted:
+            counts = [round(count, 6) for count in counts]
+        return counts[:size], specials[:size]
+
+
+def expand(event, repeat, first, last):
+    """ Iterate over occurrences (start day, start minute, end day, end
+    minute) of a repeating event overlapping days first to last, where
+    repeat is a (kind, value, unit) org repeater. Occurrences falling on
+    a day missing from a month (e.g. 31st) are moved to the last day. """
+
+    start_day, start_minute, end_day, end_minute = event
+    kind, value, unit = repeat
+    value = max(int(value), 1)
+    span = end_day - start_day
+
+    # Hours (only meaningful for timed events, else rounded to days)
+    if unit == "h" and start_minute >= 0:
+        step = 60*value
+        origin = start_day*1440 + start_minute
+        i = max(0, -(-((first-span-1)*1440 - origin) // step))
+        while origin + i*step <= last*1440 + 1439:
+            start = origin + i*step
+            day, minute = divmod(start, 1440)
+            if end_minute >= 0:
+                end = start + (end_day*1440 + end_minute) - origin
+                occurrence = day, minute, end // 1440, end % 1440
+            else:
+                occurrence = day, minute, day + span, -1
+            if occurrence[2] >= first:
+                yield occurrence
+            i += 1
+        return
+
+    # Days and weeks
+    if unit in "hdw":
+        step = {"h": max(value // 24, 1), "d": value, "w": 7*value}[unit]
+        i = max(0, -(-(first - span - start_day) // step))
+        while start_day + i*step <= last:
+            day = start_day + i*step
+            yield day, start_minute, day + span, end_minute
+            i += 1
+        return
+
+    # Months and years
+    step = value if unit == "m" else 12*value
+    date = datetime.date.fromordinal(start_day)
+    month = date.year*12 + date.month - 1
+    earliest = datetime.date.fromordinal(max(first - span, 1))
+    i = max(0, (earliest.year*12 + earliest.month - 1 - month) // step - 1)
+    while True:
+        year, index = divmod(month + i*step, 12)
+        if year > datetime.MAXYEAR:
+            return
+        days = calendar.monthrange(year, index+1)[1]
+        day = datetime.date(year, index+1, min(date.day, days)).toordinal()
+        if day > last:
+            return
+        if day + span >= first:
+            yield day, start_minute, day + span, end_minute
+        i += 1
+
+
+def tokenize(text):
+    """ Return lowercase words of text. """
+
+    return re.findall(r"\w+", text.lower())
+
+
+def split(date):
+    """ Split date or datetime into day ordinal and minutes (-1 if no time). """
+
+    if isinstance(date, datetime.datetime):
+        return date.toordinal(), date.hour*60 + date.minute
+    return date.toordinal(), -1
+
+
+def join(ordinal, minutes):
+    """ Build date (or datetime if minutes >= 0) from day ordinal and minutes. """
+
+    date = datetime.date.fromordinal(ordinal)
+    if minutes < 0:
+        return date
+    return datetime.datetime(date.year, date.month, date.day, minutes // 60, minutes % 60)
+
+
+# ----------------------------------------------------------------------
+if __name__ == "__main__":
+    # Consistency check of incremental updates (rows, rules and inverted
+    # index) against a store built at once
+    import sys
+    import random
+    import datetime
+
+    random.seed(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    names = "alpha beta gamma delta meeting party review".split()
+    def record():
+        start = datetime.date(2021, 1, 1) + datetime.timedelta(days=random.randrange(365))
+        end = start + datetime.timedelta(days=random.choice((0, 0, 1, 7)))
+        repeat = ("+", 1, "w") if random.random() < 0.05 else None
+        description = " ".join(random.sample(names, 2) + ["w%d" % random.randrange(100)])
+        return (description, start, end, random.random() < 0.2,
+                repeat, tuple(sorted(random.sample(("work", "home"), random.randint(0, 2)))))
+
+    store, files = EventStore(), {}
+    for step in range(200):
+        filename = "%d.org" % random.randrange(5)
+        if filename in files and random.random() < 0.1:
+            del files[filename]
+            store.update([filename], {})
+        else:
+            files[filename] = [record() for i in range(random.randrange(20))]
+            store.update([], { filename: files[filename] })
+        fresh = EventStore()
+        fresh.ids = dict(store.ids)
+        fresh.update([], files)
+        first = datetime.date(2021, 1, 1).toordinal()
+        last = datetime.date(2021, 12, 31).toordinal()
+        if (store.words != sorted(set(store.words)) or len(store.words) != len(store.postings)
+            or store.records(first, last) != fresh.records(first, last)
+            or store.histogram(first, last) != fresh.histogram(first, last)
+            or any(store.records(first, last, store.search(query)) !=
+                   fresh.records(first, last, fresh.search(query))
+                   for query in ("a", "al", "party", "work r", "1", "zz"))):
+            print("Step %d: MISMATCH" % step)
+            sys.exit(1)
+    print("%d updates, %d events, %d words: ok" % (step+1, len(store), len(store.words)))
@@ -0,0 +1,84 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Lightweight instrumentation: functions decorated with timed(name) record
+# their number of calls and time spent (total, in current frame and in last
+# frame), and count(name) updates counters (e.g. dropped input events). A
+# frame ends whenever frame() is called (after terminal flush).
+import time
+import functools
+
+
+class Section:
+    """ Statistics of a measured section. """
+
+    __slots__ = ("calls", "total", "current", "last", "last_calls", "frame_calls")
+
+    def __init__(self):
+        self.calls = 0          # number of calls since start
+        self.total = 0.0        # time spent since start
+        self.current = 0.0      # time spent in current frame
+        self.frame_calls = 0    # number of calls in current frame
+        self.last = 0.0         # time spent in last frame
+        self.last_calls = 0     # number of calls in last frame
+
+
+sections = {}   # name -> Section
+counters = {}   # name -> value
+
+
+def timed(name):
+    """ Decorator measuring calls of a function as section name. """
+
+    def decorator(function):
+        section = sections.setdefault(name, Section())
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                section.calls += 1
+                section.total += elapsed
+                section.frame_calls += 1
+                section.current += elapsed
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """ Add value to counter name. """
+
+    counters[name] = counters.get(name, 0) + value
+
+
+def frame(empty=False):
+    """ End current frame, which becomes the last frame unless empty
+    (nothing was drawn). """
+
+    for section in sections.values():
+        if not empty:
+            section.last, section.last_calls = section.current, section.frame_calls
+        section.current, section.frame_calls = 0.0, 0
+
+
+def overlay():
+    """ Return lines describing last frame (sections and counters). """
+
+    lines = ["%-16s %9.3f ms %5d calls" % (name, 1000*section.last, section.last_calls)
+             for name, section in sections.items()]
+    lines += ["%-16s %12d" % (name, value) for name, value in counters.items()]
+    return lines
+
+
+def report():
+    """ Return lines describing all sections and counters since start. """
+
+    lines = ["%-16s %10.3f ms total %8d calls %9.3f ms/call" % (
+                 name, 1000*section.total, section.calls,
+                 1000*section.total / max(section.calls, 1))
+             for name, section in sections.items()]
+    lines += ["%-16s %12d" % (name, value) for name, value in counters.items()]
+    return lines
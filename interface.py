@@ -0,0 +1,298 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+import sys
+import signal
+import asyncio
+import datetime
+import instrument
+from terminal import Mouse
+from layout import Layout
+
+
+class Interface:
+    """ Interactive agenda driven by an asyncio event loop.
+
+    Terminal input is processed as soon as available, agenda files are
+    watched (stat polling) and reparsed in a worker thread while the
+    interface stays responsive, new events being merged at once when
+    parsing is over. Calendar is also redrawn at midnight.
+
+    Previous and next years are shown with left/right (or p/n) keys and
+    current year with home (or t). Days of a year are only computed when
+    first shown and adjacent years are then prepared in background. An
+    overlay showing timings of the last frame is toggled with i.
+
+    Slash starts an incremental search of events (descriptions, tags and
+    file names): days with matching events are highlighted and only
+    matching events are listed. Return ends the query (keeping the
+    filter) and escape clears the search.
+
+    Months are arranged to fit the terminal width, and arranged again
+    whenever the terminal is resized. """
+
+    def __init__(self, agenda, terminal, interval=1.0):
+        """ Build an interface for agenda using terminal and checking for
+        modified files every interval seconds (0 to disable). """
+
+        self.agenda = agenda
+        self.terminal = terminal
+        self.interval = interval
+        self.selection = None, None, None  # month, day and position of hovered day
+        self.reloading = None               # running reload task
+        self.reload_again = False           # reload asked while reloading
+        self.midnight = None                # midnight redraw handle
+        self.prefetching = None             # running prefetch task
+        self.overlay = False                # whether to show timings overlay
+        self.searching = False              # whether keys edit search query
+        self.found = 0                      # number of events matching query
+        self.done = None
+
+    def run(self):
+        """ Run the interface until user quits. """
+
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        fd = sys.stdin.fileno()
+        loop.add_reader(fd, self.on_input)
+        loop.add_signal_handler(signal.SIGWINCH, self.on_resize)
+        self.agenda.layout = Layout((self.terminal.width, self.terminal.height),
+                                    self.agenda.layout.origin)
+        watcher = loop.create_task(self.watch()) if self.interval else None
+        self.schedule_midnight()
+        self.redraw()
+        self.undefer()
+        self.prefetch()
+        try:
+            await self.done
+        finally:
+            loop.remove_reader(fd)
+            loop.remove_signal_handler(signal.SIGWINCH)
+            self.midnight.cancel()
+            self.prefetching.cancel()
+            if watcher:
+                watcher.cancel()
+
+    def redraw(self):
+        """ Redraw calendar, selection and events. """
+
+        agenda = self.agenda
+        agenda.terminal.clear()
+        agenda.display_calendar()
+        month, day, position = self.selection
+        if day:
+            agenda.terminal.write(agenda.style.highlight + "%2d " % day + agenda.style.none, position)
+            agenda.display_events(datetime.date(agenda.year, month, day))
+        else:
+            agenda.display_events()
+        self.draw_search()
+        self.draw_overlay()
+        self.flush()
+
+    def draw_search(self):
+        """ Draw search query below the calendar (blank if no search). """
+
+        agenda, terminal = self.agenda, self.terminal
+        x, y = agenda.layout.origin[0], agenda.layout.search
+        terminal.write(agenda.style.none + " "*(terminal.width - x + 1), (x, y))
+        if self.searching or agenda.query:
+            s = "/" + agenda.query
+            if agenda.query:
+                s += "  (%d events)" % self.found
+            terminal.write(agenda.style.event_header + s + agenda.style.none, (x, y))
+
+    def search(self, keys):
+        """ Edit search query with keys and return remaining (command) keys. """
+
+        agenda = self.agenda
+        query, commands = agenda.query, []
+        for key in keys:
+            if not self.searching:
+                if key == "/":
+                    self.searching = True
+                elif key == "\033" and query:
+                    query = ""
+                else:
+                    commands.append(key)
+            elif key == "\033":
+                self.searching, query = False, ""
+            elif key in ("\r", "\n"):
+                self.searching = False
+            elif key in ("\x7f", "\x08"):
+                query = query[:-1]
+            elif len(key) == 1 and key.isprintable():
+                query += key
+        if query != agenda.query:
+            self.found = agenda.search(query)
+        return commands
+
+    def draw_overlay(self):
+        """ Draw timings of last frame at the bottom of the terminal. """
+
+        if not self.overlay:
+            return
+        terminal, style = self.terminal, self.agenda.style
+        lines = instrument.overlay()
+        y = max(terminal.height - len(lines), 1)
+        for line in lines:
+            terminal.write(style.none + style.event_header + line + style.none, (1, y))
+            y += 1
+
+    def hover(self, mouse):
+        """ Update selection from mouse position (only if day changed). """
+
+        agenda = self.agenda
+        hovered = agenda.get_day(mouse)
+        if hovered[:2] == self.selection[:2]:
+            return
+
+        # Clear previous selection
+        month, day, position = self.selection
+        if day:
+            agenda.terminal.write(agenda.format_day(agenda.year, month, day), position)
+
+        # Highlight new selection and display new info (day or week)
+        self.selection = month, day, position = hovered
+        if day:
+            agenda.terminal.write(agenda.style.highlight + "%2d " % day + agenda.style.none, position)
+            agenda.display_events(datetime.date(agenda.year, month, day))
+        else:
+            agenda.display_events()
+
+    def on_input(self):
+        """ Process all pending input, only keeping latest mouse position. """
+
+        keys, mouse = [], None
+        for event in self.terminal.events(timeout=0):
+            if isinstance(event, Mouse):
+                if mouse is not None:
+                    instrument.count("input_dropped")
+                mouse = event.x, event.y
+            else:
+                keys.append(event.key)
+
+        # Search (keys are part of the query while searching)
+        searching, query = self.searching, self.agenda.query
+        keys = self.search(keys)
+        if (searching, query) != (self.searching, self.agenda.query):
+            self.redraw()
+
+        # Quit
+        if "q" in keys:
+            if not self.done.done():
+                self.done.set_result(None)
+            return
+
+        # Reload agenda (in background)
+        if "r" in keys:
+            self.reload()
+
+        # Year navigation
+        year = self.agenda.year
+        for key in keys:
+            if key in ("left", "p"):
+                year -= 1
+            elif key in ("right", "n"):
+                year += 1
+            elif key in ("home", "t"):
+                year = datetime.date.today().year
+        year = min(max(year, datetime.MINYEAR), datetime.MAXYEAR)
+        if year != self.agenda.year:
+            self.agenda.year = year
+            self.selection = None, None, None
+            self.redraw()
+            self.undefer()
+            self.prefetch()
+
+        # Timings overlay
+        if "i" in keys:
+            self.overlay = not self.overlay
+            self.redraw()
+
+        if mouse is not None:
+            self.hover(mouse)
+        self.draw_overlay()
+        self.flush()
+
+    def flush(self):
+        """ Flush terminal and end frame (after flush such that flush is
+        part of the frame it draws). """
+
+        self.terminal.flush()
+        instrument.frame(empty=not self.terminal.bytes)
+
+    def on_resize(self):
+        """ Arrange months for the new terminal size and redraw. """
+
+        self.terminal.resize(clear=True)
+        self.agenda.layout = Layout((self.terminal.width, self.terminal.height),
+                                    self.agenda.layout.origin)
+        self.selection = None, None, None
+        self.redraw()
+
+    def undefer(self):
+        """ Parse deferred (archive) files in background if displayed year
+        is before the first event of other files. Prefetched years never
+        undefer files. """
+
+        if self.agenda.undefer(self.agenda.year):
+            self.reload()
+
+    def prefetch(self):
+        """ Prepare years adjacent to the displayed one in background. """
+
+        if self.prefetching is not None:
+            self.prefetching.cancel()
+        self.prefetching = asyncio.get_running_loop().create_task(self.prefetch_task())
+
+    async def prefetch_task(self):
+        year = self.agenda.year
+        for year in (year+1, year-1):
+            if not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+                continue
+            # One month at a time such that input is processed in between
+            for month in range(1, 13):
+                await asyncio.sleep(0)
+                self.agenda.format_month(year, month)
+
+    def reload(self):
+        """ Reload agenda in background (if not already reloading). """
+
+        if self.reloading is not None and not self.reloading.done():
+            self.reload_again = True
+            return
+        self.reloading = asyncio.get_running_loop().create_task(self.reload_task())
+
+    async def reload_task(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.reload_again = False
+            patch = await loop.run_in_executor(None, self.agenda.load)
+            # Merge happens in the event loop, between two redraws
+            if self.agenda.merge(patch):
+                self.redraw()
+            if not self.reload_again:
+                break
+
+    async def watch(self):
+        """ Reload agenda whenever a file is modified. """
+
+        while True:
+            await asyncio.sleep(self.interval)
+            if (self.reloading is None or self.reloading.done()) and self.agenda.modified():
+                self.reload()
+
+    def schedule_midnight(self):
+        """ Schedule a redraw right after midnight. """
+
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                             datetime.time())
+        delay = (midnight - now).total_seconds() + 1
+        self.midnight = asyncio.get_running_loop().call_later(delay, self.on_midnight)
+
+    def on_midnight(self):
+        self.redraw()
+        self.schedule_midnight()
@@ -0,0 +1,81 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Layout of the year calendar: months (21x8 cells) are arranged on a grid
+# whose number of columns (a divisor of 12) is the largest fitting the
+# terminal width. For each shown year, a lookup table maps every cell of
+# the calendar to the day it shows such that hit-testing (mouse hover) is
+# a single table lookup. A new layout is made whenever the terminal size
+# changes.
+import calendar
+
+# Size of a month (in cells) and separation between months
+MONTH_COLS = 7*3
+MONTH_ROWS = 8
+MONTH_SEP  = 1
+
+
+class Layout:
+    """ Arrangement of months (and events) on the terminal. """
+
+    def __init__(self, size=None, origin=(1,1)):
+        """ Build the layout for terminal size (default is 4 months per
+        row) with calendar at origin. """
+
+        self.origin = origin
+        self.columns = 4
+        if size is not None:
+            width = size[0] - origin[0] + 1
+            for columns in (12, 6, 4, 3, 2, 1):
+                if columns*(MONTH_COLS+MONTH_SEP) - MONTH_SEP <= width or columns == 1:
+                    self.columns = columns
+                    break
+        self.rows = 12 // self.columns
+        self.width = self.columns*(MONTH_COLS+MONTH_SEP) - MONTH_SEP
+        self.height = self.rows*(MONTH_ROWS+MONTH_SEP) - MONTH_SEP
+
+        # Position of each month (index 0 is unused)
+        x0, y0 = origin
+        self.months = [None] + [(x0 + (i % self.columns)*(MONTH_COLS+MONTH_SEP),
+                                 y0 + (i // self.columns)*(MONTH_ROWS+MONTH_SEP))
+                                for i in range(12)]
+        # Rows of search query and events (below calendar)
+        self.search = y0 + self.height
+        self.events = self.search + 1
+        self.tables = {}    # year -> lookup table
+
+    def table(self, year):
+        """ Return lookup table of year where the (relative) cell (x,y) of
+        the calendar is at index y*width + x and holds (month, day,
+        position of day) or None. """
+
+        table = self.tables.get(year)
+        if table is not None:
+            return table
+        table = [None] * (self.width*self.height)
+        x0, y0 = self.origin
+        for month in range(1, 13):
+            mx, my = self.months[month]
+            first = calendar.weekday(year, month, 1)
+            last = calendar.monthrange(year, month)[1]
+            for day in range(1, last+1):
+                row, column = divmod(first + day - 1, 7)
+                x, y = mx + 3*column, my + 2 + row
+                entry = month, day, (x, y)
+                index = (y-y0)*self.width + (x-x0)
+                table[index:index+3] = entry, entry, entry
+        if len(self.tables) > 16:
+            self.tables.clear()
+        self.tables[year] = table
+        return table
+
+    def day(self, year, position):
+        """ Return (month, day, position of day) at position (terminal cell)
+        or (None, None, None). """
+
+        x, y = position[0] - self.origin[0], position[1] - self.origin[1]
+        if 0 <= x < self.width and 0 <= y < self.height:
+            entry = self.table(year)[y*self.width + x]
+            if entry is not None:
+                return entry
+        return None, None, None
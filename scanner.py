@@ -0,0 +1,242 @@
+# Console agenda - Copyright (c) 2021 Nicolas P. Rougier
+# Released under the GNU General Public Licence version 3
+#
+# Fast line-streaming org scanner. It extracts the very same event records
+# as agenda.parse (which relies on orgparse) without building any node
+# tree: headings, active timestamps (points and ranges) and deadlines are
+# read in a single pass over the lines of the file, following orgparse
+# rules (SCHEDULED/DEADLINE/CLOSED line, CLOCK lines, properties drawer and
+# state change notes are not considered as timestamps).
+import re
+import datetime
+
+# Name and version of the parser producing event records (used by the cache)
+PARSER = "fast", 3
+
+# Same structure as orgparse timestamp regex (see orgparse.date)
+def _timestamp(prefix, bo, bc):
+    ignore = "[^%s]" % bc
+    return (r"{bo}(?P<{p}year>\d{{4}})-(?P<{p}month>\d{{2}})-(?P<{p}day>\d{{2}})"
+            r"(({i}+?)(?P<{p}hour>\d{{2}}):(?P<{p}min>\d{{2}})"
+            r"(--?(?P<{p}end_hour>\d{{2}}):(?P<{p}end_min>\d{{2}}))?)?"
+            r"(({i}+?)(?P<{p}repeatpre>[\.\+]{{1,2}})(?P<{p}repeatnum>\d+)(?P<{p}repeatdwmy>[hdwmy]))?"
+            r"(({i}+?)(\-)(\d+)([hdwmy]))?"
+            r"({i}*?){bc}").format(p=prefix, i=ignore, bo=bo, bc=bc)
+
+TIMESTAMP = re.compile(_timestamp("a", "<", ">") + "|" + _timestamp("i", r"\[", r"\]"))
+DEADLINE  = re.compile(r"^(?!\#).*DEADLINE:\s+" + _timestamp("", "<", ">"))
+SCHEDULED = re.compile(r"^(?!\#).*SCHEDULED:\s+" + _timestamp("", "<", ">"))
+CLOSED    = re.compile(r"^(?!\#).*CLOSED:\s+" + _timestamp("", r"\[", r"\]"))
+CLOCK     = re.compile(r"^(?!#).*CLOCK:\s+\[(\d+)\-(\d+)\-(\d+)[^\]\d]*(\d+)\:(\d+)\]")
+STATE     = re.compile(r'\s*-\s+State\s+"([^"]+)"\s+from\s+"([^"]+)"\s+\[([^\]]+)\]')
+HEADING   = re.compile(r"^(\*+)\s+(.*?)\s*$")
+TAGS      = re.compile(r"(.*?)\s*:([\w@:]+):\s*$")
+PRIORITY  = re.compile(r"^\s*\[#([A-Z0-9])\] ?(.*)$")
+LINK      = re.compile(r"\[\[(?P<desc0>[^\]]+)\]\]|\[\[(?P<link1>[^\]]+)\]\[(?P<desc1>[^\]]+)\]\]")
+CLEANUP   = re.compile(r"\[.*\]|\<.*\>|NEXT|TODO")
+KEYWORDS  = re.compile(r"^[ \t]*#\+((?:SEQ_|TYP_)?TODO):(.*)$", re.MULTILINE | re.IGNORECASE)
+
+
+def _date(match, prefix="", hour="hour", minute="min"):
+    """ Return date or datetime from a timestamp match. """
+
+    year, month, day = match.group(prefix+"year", prefix+"month", prefix+"day")
+    h, m = match.group(prefix+hour, prefix+minute)
+    if h is not None and m is not None:
+        return datetime.datetime(int(year), int(month), int(day), int(h), int(m))
+    return datetime.date(int(year), int(month), int(day))
+
+
+def _repeat(match, prefix=""):
+    """ Return (kind, value, unit) repeater of a timestamp match (or None). """
+
+    kind = match.group(prefix+"repeatpre")
+    if kind is None:
+        return None
+    return kind, int(match.group(prefix+"repeatnum")), match.group(prefix+"repeatdwmy")
+
+
+def timestamps(string):
+    """ Iterate over active timestamps in string as (start, end, repeat) tuples. """
+
+    while True:
+        match = TIMESTAMP.search(string)
+        if not match:
+            return
+        rest = string[match.end():]
+        prefix, rangedash = ("a", "--<") if match.group("ayear") else ("i", "--[")
+        end = None
+        if rest.startswith(rangedash):
+            match2 = TIMESTAMP.search(rest)
+            if match2 and match2.group(prefix+"year"):
+                rest = rest[match2.end():]
+                end = _date(match2, prefix)
+        if end is None and match.group(prefix+"end_hour") is not None:
+            end = _date(match, prefix, "end_hour", "end_min")
+        if prefix == "a":
+            yield _date(match, prefix), end, _repeat(match, prefix)
+        string = rest
+
+
+def todo_keywords(text):
+    """ Return TODO keywords (including done ones) declared in text. """
+
+    keywords = []
+    for key, value in KEYWORDS.findall(text):
+        value = value.strip().replace("|", " ")
+        keywords.extend(word.split("(", 1)[0] for word in value.split())
+    return keywords or ["TODO", "DONE"]
+
+
+def scan(lines, keywords=("TODO", "DONE"), skip=False):
+    """ Iterate over (description, start, end, special, repeat, tags)
+    records of lines, ignoring archived (ARCHIVE tag) and commented
+    (COMMENT keyword) subtrees if skip. """
+
+    heading, pending, tags = None, None, ()
+    parents = []   # (level, tags) of ancestors
+    skipped = 0    # level of skipped subtree (0 if none)
+    for line in lines:
+        if line.startswith("*"):
+            stars = len(line) - len(line.lstrip("*"))
+            if line[stars:stars+1] == " ":
+                # Lines of a skipped subtree are only checked for headings
+                if skipped and stars > skipped:
+                    continue
+                skipped = 0
+
+                # Heading timestamps of a node without body
+                if pending:
+                    for start, end, repeat in pending:
+                        yield heading, start, end, False, repeat, tags
+
+                # New node: heading, tags (including inherited ones), todo
+                # keyword, priority
+                text = HEADING.match(line).group(2)
+                match = text.endswith(":") and TAGS.search(text)
+                tags = set()
+                if match:
+                    text = match.group(1)
+                    tags.update(match.group(2).split(":"))
+                archived = "ARCHIVE" in tags
+                while parents and parents[-1][0] >= stars:
+                    parents.pop()
+                if parents:
+                    tags |= parents[-1][1]
+                parents.append((stars, tags))
+                tags = tuple(sorted(tags))
+                for keyword in keywords:
+                    if text == keyword:
+                        text = ""
+                        break
+                    if text.startswith(keyword + " "):
+                        text = text[len(keyword)+1:]
+                        break
+                match = "[#" in text and PRIORITY.search(text)
+                if match:
+                    text = match.group(2)
+                if skip and (archived or text == "COMMENT" or text.startswith("COMMENT ")):
+                    heading, pending, skipped = None, None, stars
+                    continue
+                heading = text
+                if "[[" in heading:
+                    heading = LINK.sub(lambda m: m.group("desc0") or m.group("desc1"), heading)
+                heading = CLEANUP.sub("", heading).strip()
+                pending = list(timestamps(text)) if "<" in text else []
+                drawer = 0
+                continue
+
+        # Content before first heading (or of a skipped subtree)
+        if heading is None:
+            continue
+
+        # First line may hold SCHEDULED, DEADLINE or CLOSED timestamps.
+        # Deadline comes first, then heading timestamps (as in agenda.parse)
+        if pending is not None:
+            deadline = "DEADLINE:" in line and DEADLINE.search(line)
+            if deadline:
+                yield heading, _date(deadline), None, True, _repeat(deadline), tags
+            for start, end, repeat in pending:
+                yield heading, start, end, False, repeat, tags
+            pending = None
+            if (deadline or ("SCHEDULED:" in line and SCHEDULED.search(line))
+                         or ("CLOSED:" in line and CLOSED.search(line))):
+                continue
+
+        if "CLOCK:" in line and CLOCK.search(line):
+            continue
+
+        # Properties drawer (only the first one, as orgparse does)
+        if drawer == 1:
+            if ":END:" in line:
+                drawer = 2
+            continue
+        if drawer == 0 and ":PROPERTIES:" in line:
+            drawer = 1
+            continue
+
+        if "State" in line and STATE.search(line):
+            continue
+
+        # No active timestamp without '<'
+        if "<" in line:
+            for start, end, repeat in timestamps(line):
+                yield heading, start, end, False, repeat, tags
+
+    if pending:
+        for start, end, repeat in pending:
+            yield heading, start, end, False, repeat, tags
+
+
+def parse(text, filename="<string>", skip=False):
+    """ Parse org text and return the list of its (unsorted) events as
+    (description, start, end, special, repeat, tags) records, ignoring
+    archived and commented subtrees if skip. """
+
+    return list(scan(text.splitlines(), todo_keywords(text), skip))
+
+
+# ----------------------------------------------------------------------
+if __name__ == "__main__":
+    # Conformance check against the orgparse based parser, on given files
+    # or on the fixtures (with and without skipping archived subtrees)
+    import os
+    import sys
+    import glob
+    import time
+    import agenda
+
+    filenames = sys.argv[1:]
+    if not filenames:
+        fixtures = os.path.join(os.path.dirname(__file__), "fixtures")
+        filenames = sorted(glob.glob(os.path.join(fixtures, "*.org")))
+
+    status = 0
+    for filename in filenames:
+        # Line endings are kept (as when agenda reads files)
+        with open(filename, encoding="utf8", newline="") as file:
+            text = file.read()
+        for skip in (False, True):
+            t0 = time.perf_counter()
+            expected = agenda.parse(text, filename, skip)
+            t1 = time.perf_counter()
+            records = parse(text, filename, skip)
+            t2 = time.perf_counter()
+
+            name = filename + (" (skip)" if skip else "")
+            if records == expected and (records or sys.argv[1:]):
+                print("%s: %d events, orgparse %.3fs, fast %.3fs (x%.1f)" % (
+                    name, len(records), t1-t0, t2-t1, (t1-t0)/max(t2-t1, 1e-9)))
+            elif records == expected:
+                status = 1
+                print("%s: NO EVENT" % name)
+            else:
+                status = 1
+                print("%s: MISMATCH" % name)
+                for record in expected:
+                    if record not in records:
+                        print("  missing: ", record)
+                for record in records:
+                    if record not in expected:
+                        print("  extra:   ", record)
+    sys.exit(status)
@@ -1,5 +1,8 @@
 # Console agenda - Copyright (c) 2021 Nicolas P. Rougier
 # Released under the GNU General Public Licence version 3
+import os
+import re
+import functools
 
 palettes = {
     "red":          [ "#ffebee", "#ffcdd2", "#ef9a9a", "#e57373", "#ef5350",
@@ -89,6 +92,190 @@ def BG(R,G,B):
     return "\033[48;2;%d;%d;%dm" % (R,G,B)
 
 
+# ----------------------------------------------------------------------
+# Style compiler: colors are mapped once to the nearest ones available on
+# the terminal (truecolor, 256, 16 or none) and SGR sequences are merged.
+# Rendition states (flags, foreground, background, others) allow to find
+# the shortest sequence between two renditions.
+
+DEPTHS = "truecolor", "256", "16", "none"
+
+SGR = re.compile(r"\033\[([0-9;]*)m")
+
+# SGR parameters turning off a flag (bold and light share the same)
+OFF = { 1: 22, 2: 22, 3: 23, 4: 24, 5: 25, 7: 27, 9: 29 }
+
+# Rendition state after a reset
+RESET = (), None, None, ()
+
+# ANSI colors (xterm default values)
+ANSI = [ (  0,  0,  0), (205,  0,  0), (  0,205,  0), (205,205,  0),
+         (  0,  0,238), (205,  0,205), (  0,205,205), (229,229,229),
+         (127,127,127), (255,  0,  0), (  0,255,  0), (255,255,  0),
+         ( 92, 92,255), (255,  0,255), (  0,255,255), (255,255,255) ]
+
+def depth(environ=os.environ):
+    """ Guess color depth of the terminal from environment variables. """
+
+    term = environ.get("TERM", "")
+    if "NO_COLOR" in environ or term == "dumb":
+        return "none"
+    if environ.get("COLORTERM", "").lower() in ("truecolor", "24bit") or "direct" in term:
+        return "truecolor"
+    if "256" in term:
+        return "256"
+    return "16"
+
+def xterm(index):
+    """ Return RGB values of xterm color index (0 to 255) """
+
+    if index < 16:
+        return ANSI[index]
+    if index < 232:
+        levels = 0, 95, 135, 175, 215, 255
+        index -= 16
+        return levels[index // 36], levels[(index // 6) % 6], levels[index % 6]
+    gray = 8 + 10*(index-232)
+    return gray, gray, gray
+
+@functools.lru_cache(maxsize=None)
+def nearest(rgb, depth):
+    """ Return index of the xterm color nearest to rgb for depth ("256" or "16"). """
+
+    # Colors 0-15 are often redefined by user, avoid them when possible
+    indices = range(16, 256) if depth == "256" else range(16)
+    return min(indices, key=lambda index: sum((a-b)**2 for a, b in zip(rgb, xterm(index))))
+
+def downsample(params, depth):
+    """ Return color params (e.g. "38;2;R;G;B") for given depth (None if no color). """
+
+    if depth == "none":
+        return None
+    values = [int(value) for value in params.split(";")]
+    base = values[0]
+    if base in (38, 48):
+        if values[1] == 2:
+            if depth == "truecolor":
+                return params
+            rgb = tuple(values[2:5])
+        elif depth == "16":
+            rgb = xterm(values[2])
+        else:
+            return params
+        if depth == "256":
+            return "%d;5;%d" % (base, nearest(rgb, depth))
+        index = nearest(rgb, depth)
+        base = 30 if base == 38 else 40
+        return "%d" % (base + index if index < 8 else base + 60 + index - 8)
+    return params
+
+def state(text, current=RESET):
+    """ Return rendition state after SGR sequences of text. """
+
+    flags, fg, bg, others = set(current[0]), current[1], current[2], list(current[3])
+    for params in SGR.findall(text):
+        params = params.split(";")
+        i = 0
+        while i < len(params):
+            param = int(params[i] or 0)
+            if param in (38, 48) and params[i+1:i+2] in (["2"], ["5"]):
+                size = 5 if params[i+1] == "2" else 3
+                color = ";".join(params[i:i+size])
+                i += size
+                if param == 38:
+                    fg = color
+                else:
+                    bg = color
+                continue
+            i += 1
+            if param == 0:
+                flags, fg, bg, others = set(), None, None, []
+            elif param in OFF:
+                flags.add(param)
+            elif param in OFF.values():
+                flags -= set(flag for flag in OFF if OFF[flag] == param)
+            elif 30 <= param <= 37 or 90 <= param <= 97:
+                fg = str(param)
+            elif param == 39:
+                fg = None
+            elif 40 <= param <= 47 or 100 <= param <= 107:
+                bg = str(param)
+            elif param == 49:
+                bg = None
+            else:
+                others.append(str(param))
+    return tuple(sorted(flags)), fg, bg, tuple(others)
+
+def sgr(new, old=None):
+    """ Return the shortest SGR sequence switching from old rendition state
+    (unknown if None) to new one. """
+
+    flags, fg, bg, others = new
+    params = ["0"] + [str(flag) for flag in flags] + [fg, bg] + list(others)
+    params = [param for param in params if param]
+    if old is not None:
+        if old == new:
+            return ""
+        if old[3] == others:
+            removed = set(old[0]) - set(flags)
+            added = set(flags) - set(old[0])
+            offs = set(OFF[flag] for flag in removed)
+            if 22 in offs:
+                added |= set(flag for flag in flags if OFF[flag] == 22)
+            delta = [str(param) for param in sorted(offs) + sorted(added)]
+            if fg != old[1]:
+                delta.append(fg or "39")
+            if bg != old[2]:
+                delta.append(bg or "49")
+            if len(";".join(delta)) < len(";".join(params)):
+                params = delta
+    return "\033[%sm" % ";".join(params)
+
+def compile_sgr(text, depth="truecolor"):
+    """ Return text where colors of SGR sequences are mapped to the given
+    depth and consecutive sequences merged into a single one. """
+
+    if SGR.sub("", text):
+        # Not made of SGR sequences only: compile sequences one by one
+        return SGR.sub(lambda match: compile_sgr(match.group(0), depth), text)
+
+    params = []
+    for match in SGR.finditer(text):
+        values = match.group(1).split(";")
+        i = 0
+        while i < len(values):
+            if values[i] in ("38", "48") and values[i+1:i+2] in (["2"], ["5"]):
+                size = 5 if values[i+1] == "2" else 3
+                color = downsample(";".join(values[i:i+size]), depth)
+                if color:
+                    params.append(color)
+                i += size
+                continue
+            value = values[i] or "0"
+            i += 1
+            if depth == "none" and (30 <= int(value) <= 49 or 90 <= int(value) <= 107):
+                continue
+            if value == "0":
+                params = []
+            params.append(value)
+    return "\033[%sm" % ";".join(params) if params else ""
+
+def compile(style, depth="truecolor"):
+    """ Return a copy of style (class) whose SGR sequences are merged and
+    colors mapped to the nearest ones available for depth. """
+
+    attributes = {}
+    for name in dir(style):
+        value = getattr(style, name)
+        if name.startswith("_"):
+            continue
+        if isinstance(value, str):
+            attributes[name] = compile_sgr(value, depth)
+        elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+            attributes[name] = [compile_sgr(item, depth) for item in value]
+    return type(style.__name__, (style,), attributes)
+
+
 class default:
 
     none           = NONE
@@ -103,6 +290,7 @@ class default:
 
     default        = ""
     highlight      = COLORPAIR("yellow", 3)
+    match          = WEIGHT_BOLD + EFFECT_UNDERLINE
     vacant         = DEFAULT + WEIGHT_LIGHT
     special        = ""
     
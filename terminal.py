@@ -1,56 +1,383 @@
 # Console agenda - Copyright (c) 2021 Nicolas P. Rougier
 # Released under the GNU General Public Licence version 3
+import os
+import re
 import sys
 import tty
+import shutil
+import select
 import termios
+import unicodedata
+import style
+import instrument
 
 
-class Terminal:
-    """ Terminal in raw mode in order to track mouse movements. """
-    
+# Names of cursor keys (final byte of CSI or SS3 sequences)
+KEYS = { "A": "up", "B": "down", "C": "right", "D": "left", "H": "home", "F": "end" }
+
+
+class Key:
+    """ Key press event. """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return "Key(%r)" % self.key
+
+
+class Mouse:
+    """ Mouse event at (x,y) with button (0 to 2, 3 if none) and flags. """
+
+    def __init__(self, x, y, button=3, motion=False, release=False, wheel=False):
+        self.x, self.y = x, y
+        self.button = button
+        self.motion = motion
+        self.release = release
+        self.wheel = wheel
+
+    @classmethod
+    def from_code(cls, code, x, y, release=False):
+        """ Build event from button code (as in X10 and SGR reports). """
+
+        motion = bool(code & 32)
+        release = release or ((code & 3) == 3 and not motion)
+        return cls(x, y, code & 3, motion, release, bool(code & 64))
+
+    def __repr__(self):
+        return "Mouse(%d, %d, button=%d, motion=%s, release=%s, wheel=%s)" % (
+            self.x, self.y, self.button, self.motion, self.release, self.wheel)
+
+
+class Decoder:
+    """ Incremental decoder of terminal input bytes into Key and Mouse
+    events. Handles UTF-8 text, CSI and SS3 sequences (cursor keys), X10
+    mouse reports (ESC [ M b x y) and SGR mouse reports (ESC [ < b;x;y M/m),
+    keeping incomplete sequences until more bytes are fed. """
+
     def __init__(self):
-        pass
-    
+        self.buffer = b""
+
+    def feed(self, data, final=False):
+        """ Decode data and return events. If final, incomplete sequences
+        are returned as individual keys (e.g. a lone escape key). """
+
+        buffer = self.buffer + data
+        events = []
+        i, n = 0, len(buffer)
+        while i < n:
+            event, size = self.decode(buffer, i)
+            if event is None:
+                if not final:
+                    break
+                event, size = Key(chr(buffer[i])), 1
+            events.append(event)
+            i += size
+        self.buffer = buffer[i:]
+        return events
+
+    def decode(self, buffer, i):
+        """ Decode event starting at i and return (event, size) or
+        (None, 0) if sequence is incomplete. """
+
+        n = len(buffer)
+        c = buffer[i]
+
+        # Regular character (ASCII or UTF-8 sequence)
+        if c != 0x1b:
+            size = 1 if c < 0xc0 else 2 if c < 0xe0 else 3 if c < 0xf0 else 4
+            if i + size > n:
+                return None, 0
+            return Key(buffer[i:i+size].decode("utf8", "replace")), size
+        if i+1 >= n:
+            return None, 0
+
+        # SS3 sequence
+        if buffer[i+1] == ord("O"):
+            if i+2 >= n:
+                return None, 0
+            final = chr(buffer[i+2])
+            return Key(KEYS.get(final, "\033O" + final)), 3
+
+        # Escape followed by anything but a CSI sequence
+        if buffer[i+1] != ord("["):
+            return Key("\033"), 1
+
+        # X10 mouse report
+        if i+2 < n and buffer[i+2] == ord("M"):
+            if i+6 > n:
+                return None, 0
+            code, x, y = buffer[i+3]-32, buffer[i+4]-32, buffer[i+5]-32
+            return Mouse.from_code(code, x, y), 6
+
+        # CSI sequence: parameters then a final byte in 0x40-0x7e
+        j = i+2
+        while j < n and not (0x40 <= buffer[j] <= 0x7e):
+            j += 1
+        if j >= n:
+            return None, 0
+        params, final = buffer[i+2:j].decode("latin1"), chr(buffer[j])
+
+        # SGR mouse report
+        if params.startswith("<") and final in "Mm":
+            try:
+                code, x, y = (int(value) for value in params[1:].split(";"))
+            except ValueError:
+                return Key("\033[" + params + final), j+1-i
+            return Mouse.from_code(code, x, y, release=(final == "m")), j+1-i
+        if final in KEYS and params in ("", "1"):
+            return Key(KEYS[final]), j+1-i
+        return Key("\033[" + params + final), j+1-i
+
+
+class Terminal:
+    """ Terminal in raw mode in order to track mouse movements.
+
+    Output is double buffered: write and clear only modify a frame buffer
+    holding characters and attributes (SGR sequences) of each cell, while
+    flush compares this frame with the one on screen and emits changed
+    runs of cells, in a single write. Attributes are kept in canonical
+    form and only the difference between the renditions of two adjacent
+    cells is emitted. Wide (east asian) characters take two cells, the
+    second one holding an empty string, and combining characters are
+    appended to the previous cell. """
+
+    # SGR (Select Graphic Rendition) sequence
+    SGR = re.compile(r"(\033\[[0-9;]*m)")
+
+    def __init__(self, output=None, size=None):
+        """ Create a terminal writing to output (default is stdout) with
+        given size (default is actual terminal size). """
+
+        self.output = output or sys.stdout
+        self.bytes = 0        # bytes emitted by last flush
+        self.total = 0        # bytes emitted since creation
+        self.frames = 0       # number of (non empty) flushed frames
+        self.saved = 0        # bytes saved by SGR elision since creation
+        self.canonicals = {}  # attributes -> canonical attributes
+        self.transitions = {} # (attributes, attributes) -> SGR sequence
+        self.decoder = Decoder()
+        self.resize(size)
+
+    def resize(self, size=None, clear=False):
+        """ Resize frame buffers, screen is assumed to be blank unless
+        clear is set (then screen is cleared). """
+
+        if clear:
+            self.emit("\033[0m\033[2J")
+        self.width, self.height = size or shutil.get_terminal_size()
+        self.chars = [[" "]*self.width for y in range(self.height)]
+        self.attrs = [[""]*self.width for y in range(self.height)]
+        self.screen_chars = [[" "]*self.width for y in range(self.height)]
+        self.screen_attrs = [[""]*self.width for y in range(self.height)]
+        self.dirty = set()
+        self.cursor = 1, 1
+        self.attr = ""
+        self.screen_attr = ""
+
     def write(self, text, position=None, flush=False):
         """ Write text at position and flush terminal if necessary. """
-        
+
         if position:
-            x, y = position
-            sys.stdout.write("\033[%d;%dH" % (y, x))
-        sys.stdout.write(text)
+            self.cursor = position
+        x, y = self.cursor
+        if 1 <= y <= self.height:
+            chars, attrs = self.chars[y-1], self.attrs[y-1]
+            self.dirty.add(y-1)
+        else:
+            chars, attrs = [], []
+        attr = self.attr
+        for item in self.SGR.split(text):
+            if item.startswith("\033["):
+                attr = self.canonical(attr + item)
+                continue
+            if not item:
+                continue
+            if max(item) < "\u0300":
+                # Narrow characters only: copied at once
+                first, last = max(x, 1), min(x+len(item)-1, len(chars))
+                if first <= last:
+                    if chars[first-1] == "" and first > 1:
+                        chars[first-2] = " "
+                    if last < len(chars) and chars[last] == "":
+                        chars[last] = " "
+                    chars[first-1:last] = item[first-x:last-x+1]
+                    attrs[first-1:last] = [attr]*(last-first+1)
+                x += len(item)
+                continue
+            for c in item:
+                size = 1
+                if c >= "\u0300":
+                    if unicodedata.combining(c):
+                        i = x-2
+                        if 0 < i < len(chars) and chars[i] == "":
+                            i -= 1
+                        if 0 <= i < len(chars):
+                            chars[i] += c
+                        continue
+                    if unicodedata.east_asian_width(c) in "WF":
+                        size = 2
+                if 1 <= x <= len(chars):
+                    if size == 2 and x == len(chars):
+                        # No room for a wide character
+                        c, size = " ", 1
+                    # Wide characters partially overwritten are blanked
+                    if chars[x-1] == "" and x > 1:
+                        chars[x-2] = " "
+                    if x-1+size < len(chars) and chars[x-1+size] == "":
+                        chars[x-1+size] = " "
+                    chars[x-1] = c
+                    attrs[x-1] = attr
+                    if size == 2:
+                        chars[x] = ""
+                        attrs[x] = attr
+                x += size
+        self.attr = attr
+        self.cursor = x, y
         if flush:
-            sys.stdout.flush()
+            self.flush()
 
+    @instrument.timed("flush")
     def flush(self):
-        """ Flush terminal. """
-        sys.stdout.flush()
-    
-    def read(self, count=1):
-        """ Read input. """
-        
-        return sys.stdin.read(count)
+        """ Flush terminal (only emit cells that changed since last flush). """
+
+        output = []
+        attr = self.screen_attr
+        for y in sorted(self.dirty):
+            chars, attrs = self.chars[y], self.attrs[y]
+            screen_chars, screen_attrs = self.screen_chars[y], self.screen_attrs[y]
+            if chars == screen_chars and attrs == screen_attrs:
+                continue
+            cursor = None
+            for x in range(self.width):
+                if chars[x] == screen_chars[x] and attrs[x] == screen_attrs[x]:
+                    continue
+                # Second cell of a wide character is written with the first
+                start = x-1 if chars[x] == "" and x > 0 else x
+                # Move cursor unless close enough to rewrite cells in between
+                if cursor is None or start - cursor > 4:
+                    output.append("\033[%d;%dH" % (y+1, start+1))
+                    cursor = start
+                for i in range(cursor, x+1):
+                    if attrs[i] != attr:
+                        output.append(self.transition(attr, attrs[i]))
+                        attr = attrs[i]
+                    output.append(chars[i])
+                cursor = x+1
+            screen_chars[:] = chars
+            screen_attrs[:] = attrs
+        self.dirty.clear()
+        self.screen_attr = attr
+        self.bytes = self.emit("".join(output)) if output else 0
+        if self.bytes:
+            self.frames += 1
+            instrument.count("bytes", self.bytes)
+
+    def canonical(self, attr):
+        """ Return canonical form of attributes (a single SGR sequence
+        from a reset state, empty string if no attribute). """
+
+        canonical = self.canonicals.get(attr)
+        if canonical is None:
+            state = style.state(attr)
+            canonical = "" if state == style.RESET else style.sgr(state)
+            self.canonicals[attr] = canonical
+        return canonical
+
+    def transition(self, old, new):
+        """ Return shortest SGR sequence from old to new (canonical) attributes. """
+
+        key = old, new
+        sequence = self.transitions.get(key)
+        if sequence is None:
+            sequence = style.sgr(style.state(new), style.state(old))
+            self.transitions[key] = sequence
+        # Compared to a reset followed by the new attributes
+        self.saved += 4 + len(new) - len(sequence)
+        return sequence
+
+    def lines(self, ansi=True):
+        """ Iterate over lines of the frame buffer, with SGR sequences if
+        ansi, without trailing blanks. """
+
+        for y in range(self.height):
+            chars, attrs = self.chars[y], self.attrs[y]
+            size = self.width
+            while size and chars[size-1] == " " and (not ansi or attrs[size-1] == ""):
+                size -= 1
+            if not ansi:
+                yield "".join(chars[:size])
+                continue
+            line, attr = [], ""
+            for x in range(size):
+                if attrs[x] != attr:
+                    line.append(self.transition(attr, attrs[x]))
+                    attr = attrs[x]
+                line.append(chars[x])
+            if attr:
+                line.append("\033[0m")
+            yield "".join(line)
+
+    def emit(self, text):
+        """ Write text (bypassing frame buffer) at once and return byte count. """
+
+        data = text.encode("utf8")
+        count = len(data)
+        self.total += count
+        try:
+            fd = self.output.fileno()
+        except (AttributeError, OSError, ValueError):
+            self.output.write(text)
+            self.output.flush()
+            return count
+        self.output.flush()
+        while data:
+            data = data[os.write(fd, data):]
+        return count
+
+    def events(self, timeout=None):
+        """ Wait for input (at most timeout seconds) and return all pending
+        input events. Bytes are read in bulk, as long as available. """
+
+        fd = sys.stdin.fileno()
+        events = []
+        while select.select([fd], [], [], timeout)[0]:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            events.extend(self.decoder.feed(data))
+            # Incomplete sequence: wait a bit for the rest
+            timeout = 0.05 if self.decoder.buffer else 0
+        if self.decoder.buffer:
+            events.extend(self.decoder.feed(b"", final=True))
+        return events
 
     def clear(self, position=None, flush=False):
         """ Clear screen (whole or from position) and flush if necessary. """
-        
-        if position:
-            x, y = position
-            sys.stdout.write("\033[%d;%dH " % (y, x))
-            sys.stdout.write("\033[0m" + "\033[0J")  # clear from cursor to end
-        else:
-            sys.stdout.write("\033[0m" + "\033[2J")  # clear the whole creen
+
+        x, y = position or (1, 1)
+        for row in range(max(y-1, 0), self.height):
+            start = x-1 if row == y-1 else 0
+            if 0 < start < self.width and self.chars[row][start] == "":
+                self.chars[row][start-1] = " "
+            self.chars[row][start:] = [" "]*(self.width-start)
+            self.attrs[row][start:] = [""]*(self.width-start)
+            self.dirty.add(row)
+        self.cursor = x, y
+        self.attr = ""
         if flush:
-            sys.stdout.flush()
+            self.flush()
     
     def __enter__(self):
         """ Setup raw mode. """
         
-        self.write("\0337")       # save current cursor position
-        self.write("\033[?47h")   # save screen
-        self.write("\033[?25l")   # make cursor invisible
-        self.write("\033[?1003h") # enable mouse reporting
-        self.write("\033[2J")     # clear whole screen
-        self.flush()
+        self.emit("\0337"         # save current cursor position
+                  "\033[?47h"     # save screen
+                  "\033[?25l"     # make cursor invisible
+                  "\033[?1003h"   # enable mouse reporting
+                  "\033[?1006h"   # enable SGR mouse mode
+                  "\033[0m\033[2J") # clear whole screen
+        self.resize()
 
         self.fd = sys.stdin.fileno()
         self.mode = termios.tcgetattr(self.fd)
@@ -64,11 +391,12 @@ class Terminal:
         """ Restore terminal settings. """
         
         termios.tcsetattr(self.fd, termios.TCSADRAIN, self.mode)
-        self.write("\x1b[?1003l") # disable mouse reporting
-        self.write("\033[?25h")   # make cursor visible
-        self.write("\033[?47l")   # restore screen
-        self.write("\0338")       # restore current cursor position
-        self.flush()
+        self.emit("\033[0m"       # reset attributes
+                  "\033[?1006l"   # disable SGR mouse mode
+                  "\x1b[?1003l"   # disable mouse reporting
+                  "\033[?25h"     # make cursor visible
+                  "\033[?47l"     # restore screen
+                  "\0338")        # restore current cursor position
 
 
 # ----------------------------------------------------------------------
@@ -76,13 +404,10 @@ if __name__ == "__main__":
     with Terminal() as terminal:
         terminal.write("Press 'q' to quit", (1,1), flush=True)
         while True:
-            c = terminal.read()
-            if c == "q":
+            events = terminal.events()
+            if any(isinstance(event, Key) and event.key == "q" for event in events):
                 break
-            elif c == "\033":
-                c = terminal.read(2)
-                if c == "[M":
-                    control = terminal.read()
-                    x = ord(terminal.read()) - 32
-                    y = ord(terminal.read()) - 32
-                    terminal.write("#", (x,y), flush=True)
+            for event in events:
+                if isinstance(event, Mouse):
+                    terminal.write("#", (event.x, event.y))
+            terminal.flush()